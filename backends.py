@@ -0,0 +1,328 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Hardware backends
+#
+# The display driver and the input thread only talk to the hardware
+# through the objects returned here, so everything can run (and be
+# profiled) off the Pi:
+#   hw  : spidev + wiringpi2 for the display, RPi.GPIO for the inputs
+#   sim : simulated SPI bus and GPIO, the SPI bus decodes the SSD1351
+#         command stream into a virtual GRAM and models transfer time
+#
+# The backend is picked with the PIOCLOCK_BACKEND environment variable
+# (default: hw).
+# ----------------------------------------------------------------------
+
+import os
+import time
+import threading
+import numpy as np
+
+BACKEND = os.environ.get("PIOCLOCK_BACKEND", "hw")
+
+
+def open_display(bus, device, dc_pin, backend=None):
+    """Return the (spi, gpio) pair used by the display driver"""
+    backend = backend or BACKEND
+    if backend == "sim":
+        gpio = SimGPIO()
+        return SimSPI(bus, device, gpio, dc_pin), gpio
+    import spidev
+    import wiringpi2
+    return (spidev.SpiDev(bus, device),
+            wiringpi2.GPIO(wiringpi2.GPIO.WPI_MODE_PINS))
+
+
+_rpi_gpio = None
+
+
+def rpi_gpio(backend=None):
+    """Return the RPi.GPIO module, or its simulated counterpart"""
+    global _rpi_gpio
+    backend = backend or BACKEND
+    if backend == "sim":
+        if _rpi_gpio is None:
+            _rpi_gpio = SimRPiGPIO()
+        return _rpi_gpio
+    import RPi.GPIO
+    return RPi.GPIO
+
+
+class SimGPIO(object):
+    """wiringpi2.GPIO look-alike"""
+    INPUT = 0
+    OUTPUT = 1
+    LOW = 0
+    HIGH = 1
+    WPI_MODE_PINS = 0
+
+    def __init__(self, mode=WPI_MODE_PINS):
+        self.levels = {}
+        self.modes = {}
+        self.listeners = {}
+        self.writes = 0
+
+    def pinMode(self, pin, mode):
+        self.modes[pin] = mode
+
+    def digitalWrite(self, pin, level):
+        self.writes += 1
+        if self.levels.get(pin) == level:
+            return
+        self.levels[pin] = level
+        for listener in self.listeners.get(pin, ()):
+            listener(level)
+
+    def digitalRead(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def listen(self, pin, callback):
+        """Call callback(level) on every level change of pin"""
+        self.listeners.setdefault(pin, []).append(callback)
+
+
+class SimSPI(object):
+    """spidev.SpiDev look-alike wired to a virtual SSD1351
+
+       Bytes sent with D/C low are commands, bytes sent with D/C high are
+       command arguments, or pixels after a WRITERAM command."""
+    CMD_SETCOLUMN = 0x15
+    CMD_SETROW = 0x75
+    CMD_WRITERAM = 0x5C
+    CMD_HORIZSCROLL = 0x96
+    CMD_STOPSCROLL = 0x9E
+    CMD_STARTSCROLL = 0x9F
+
+    # spidev refuses bigger writebytes() lists
+    MAX_LIST = 4096
+    # timing model, in seconds
+    TRANSFER_OVERHEAD = 30e-6   # ioctl + driver setup, per transfer
+    GPIO_WRITE = 1e-6           # D/C pin toggle
+    # scrolling model: panel refresh rate, and frames per scroll step
+    # for each scroll interval setting
+    FRAME_RATE = 100.0
+    SCROLL_FRAMES = {0: 1, 1: 10, 2: 100, 3: 200}
+
+    def __init__(self, bus=0, device=0, gpio=None, dc_pin=None,
+                 cols=128, rows=128):
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.gpio = gpio
+        self.dc = 0
+        if gpio is not None:
+            gpio.listen(dc_pin, self.on_dc)
+        self.gram = np.zeros((rows, cols), np.uint16)
+        self.lock = threading.Lock()
+        # decoder state
+        self.cmd = None
+        self.args = []
+        self.registers = {}
+        self.window = (0, 0, cols - 1, rows - 1)
+        self.cursor = 0
+        self.pending = None
+        # (top, rows, step, frames, start time) while scrolling
+        self.scrolling = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.commands = 0
+        self.pixels = 0
+        self.dc_toggles = 0
+        self.elapsed = 0.0
+        # pixels written to a band being scrolled
+        self.scroll_writes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"transfers": self.transfers, "bytes": self.bytes,
+                    "commands": self.commands, "pixels": self.pixels,
+                    "dc_toggles": self.dc_toggles,
+                    "elapsed": self.elapsed,
+                    "scroll_writes": self.scroll_writes,
+                    "max_speed_hz": self.max_speed_hz}
+
+    def on_dc(self, level):
+        with self.lock:
+            self.dc = level
+            self.dc_toggles += 1
+            self.elapsed += self.GPIO_WRITE
+
+    def writebytes(self, values):
+        if len(values) > self.MAX_LIST:
+            raise OverflowError("Argument list size exceeds %d bytes"
+                                % self.MAX_LIST)
+        self.writebytes2(bytearray(values))
+
+    def writebytes2(self, buf):
+        data = np.asarray(buf, np.uint8).ravel()
+        with self.lock:
+            self.transfers += 1
+            self.bytes += data.size
+            self.elapsed += (self.TRANSFER_OVERHEAD +
+                             data.size * 8.0 / self.max_speed_hz)
+            if self.dc:
+                self._data(data)
+            else:
+                for cmd in data:
+                    self._command(int(cmd))
+
+    def xfer2(self, values):
+        self.writebytes2(bytearray(values))
+        return [0] * len(values)
+
+    def close(self):
+        pass
+
+    def _command(self, cmd):
+        self.commands += 1
+        self.cmd = cmd
+        self.args = []
+        self.pending = None
+        if cmd == self.CMD_WRITERAM:
+            self.cursor = 0
+        elif cmd == self.CMD_STARTSCROLL:
+            step, top, rows, _, interval = \
+                self.registers.get(self.CMD_HORIZSCROLL, [0, 0, 0, 0, 0])
+            if step > 127:
+                step -= 256
+            self.scrolling = (top, rows, step,
+                              self.SCROLL_FRAMES.get(interval, 1), time.time())
+        elif cmd == self.CMD_STOPSCROLL and self.scrolling is not None:
+            # the band is left where it scrolled to
+            top, rows = self.scrolling[:2]
+            self.gram[top:top+rows] = self._scrolled(self.gram[top:top+rows])
+            self.scrolling = None
+
+    def _scrolled(self, band):
+        top, rows, step, frames, start = self.scrolling
+        steps = int((time.time() - start) * self.FRAME_RATE / frames)
+        return np.roll(band, steps * step, axis=1)
+
+    def _data(self, data):
+        if self.cmd == self.CMD_WRITERAM:
+            self._pixels(data)
+            return
+        self.args.extend(int(d) for d in data)
+        if self.cmd == self.CMD_SETCOLUMN and len(self.args) >= 2:
+            self.window = (self.args[0], self.window[1],
+                           self.args[1], self.window[3])
+        elif self.cmd == self.CMD_SETROW and len(self.args) >= 2:
+            self.window = (self.window[0], self.args[0],
+                           self.window[2], self.args[1])
+        self.registers[self.cmd] = list(self.args)
+
+    def _pixels(self, data):
+        if self.pending is not None:
+            data = np.concatenate(([self.pending], data))
+            self.pending = None
+        if data.size % 2:
+            self.pending = data[-1]
+            data = data[:-1]
+        n = data.size // 2
+        if n == 0:
+            return
+        pixels = (data[0::2].astype(np.uint16) << 8) | data[1::2]
+        x0, y0, x1, y1 = self.window
+        w = x1 - x0 + 1
+        h = y1 - y0 + 1
+        idx = self.cursor + np.arange(n)
+        ys = y0 + (idx // w) % h
+        self.gram[ys, x0 + idx % w] = pixels
+        if self.scrolling is not None:
+            top, rows = self.scrolling[:2]
+            self.scroll_writes += int(((ys >= top) & (ys < top + rows)).sum())
+        self.cursor = (self.cursor + n) % (w * h)
+        self.pixels += n
+
+    def snapshot(self, rows=None):
+        """Return the GRAM content as a RGB888 array"""
+        with self.lock:
+            gram = self.gram.copy()
+            if self.scrolling is not None:
+                top, n = self.scrolling[:2]
+                gram[top:top+n] = self._scrolled(gram[top:top+n])
+            gram = gram[:rows]
+        rgb = np.empty(gram.shape + (3,), np.uint8)
+        rgb[..., 0] = (gram >> 8) & 0xF8
+        rgb[..., 1] = (gram >> 3) & 0xFC
+        rgb[..., 2] = (gram << 3) & 0xF8
+        return rgb
+
+
+class SimRPiGPIO(object):
+    """RPi.GPIO look-alike, inputs are driven with set_input()"""
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF):
+        with self.lock:
+            self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP \
+                else self.LOW
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, level):
+        with self.lock:
+            self.levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+        with self.lock:
+            self.events[pin] = [edge, [], bouncetime / 1000.0, None]
+        if callback is not None:
+            self.add_event_callback(pin, callback)
+
+    def add_event_callback(self, pin, callback):
+        with self.lock:
+            self.events[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.events.pop(pin, None)
+
+    def cleanup(self):
+        with self.lock:
+            self.events.clear()
+
+    def set_input(self, pin, level):
+        """Drive an input pin, firing the matching edge callbacks"""
+        with self.lock:
+            previous = self.levels.get(pin, self.LOW)
+            self.levels[pin] = level
+            event = self.events.get(pin)
+            if event is None or previous == level:
+                return
+            edge, callbacks, bouncetime, last = event
+            if edge == self.RISING and not level or \
+               edge == self.FALLING and level:
+                return
+            now = time.time()
+            if last is not None and now - last < bouncetime:
+                return
+            event[3] = now
+            callbacks = list(callbacks)
+        for callback in callbacks:
+            callback(pin)
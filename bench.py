@@ -0,0 +1,397 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Frame pipeline benchmark
+#
+# Drive the Clock widgets and the display driver on the simulated
+# backend, with stubbed data sources, and report per stage latency
+# (p50/p99), allocations and bytes sent per frame.
+# Frames go through the same path as piOClock.run (clear, compose,
+# display); each widget painter is also timed alone on a scratch buffer,
+# and the frame is converted to RGB565 with every conversion mode.
+#
+#   ./bench.py -n 500 -o before.json
+#   ./bench.py -n 500 -o after.json --compare before.json
+#
+# Allocations are the numpy arrays and PIL images created per call,
+# counted by wrapping their constructors: gc does not track them. The
+# net number of new gc tracked objects is reported too, as gc_objects.
+#
+#   ./bench.py --check-glyphs
+#
+# compares the text drawn from the glyph atlases with ImageDraw.text.
+# ----------------------------------------------------------------------
+
+import os
+os.environ.setdefault("PIOCLOCK_BACKEND", "sim")
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import threading
+from timeit import default_timer as timer
+
+import numpy as np
+from PIL import Image
+
+import rgb565
+import ssd1351
+import th
+import clock
+import events
+import glyphs
+
+FRAME_BUDGET = 1.0
+
+
+class StubThread(th.Thread):
+    """Data source thread that never runs, the bench updates it"""
+    def run(self):
+        pass
+
+
+class StubMPlayer(StubThread):
+    def __init__(self):
+        super(StubMPlayer, self).__init__()
+        self.title = "Some Song - Some Artist"
+        self.status = {'state': "play", 'volume': "60"}
+        self.playlist = [{'title': "song %d" % i, 'pos': str(i)}
+                         for i in range(12)]
+
+    def play(self, pos=None):
+        pass
+
+    next = prev = rise = sleep = stop_playing = play
+
+    def vol(self, volume):
+        pass
+
+
+class StubTempNode(StubThread):
+    def __init__(self):
+        super(StubTempNode, self).__init__()
+        self.temp = 21.5
+
+
+class StubHWmonitor(StubThread):
+    def __init__(self):
+        super(StubHWmonitor, self).__init__()
+        self.cpu = 10
+        self.wifi_signal = 70
+
+    def get_ip_address(self, ifname):
+        return "192.168.0.42"
+
+
+class StubAudio(StubThread):
+    def __init__(self):
+        super(StubAudio, self).__init__()
+        self.volume = 60
+
+
+class StubInput(StubThread):
+    def __init__(self):
+        super(StubInput, self).__init__()
+        self.wheel = 0
+        self.steps = 0
+        self.click = False
+        self.has_input = threading.Event()
+
+
+def stub_sources():
+    th.MPlayer = StubMPlayer
+    th.TempNode = StubTempNode
+    th.HWmonitor = StubHWmonitor
+    th.Audio = StubAudio
+    th.Input = StubInput
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class Allocations(object):
+    """Count the numpy arrays and PIL images created while installed"""
+    NUMPY = ("array", "asarray", "empty", "empty_like", "zeros",
+             "zeros_like", "ones", "full", "copy", "roll")
+    PIL = ("new", "fromarray", "frombuffer")
+    IMAGE = ("copy", "crop", "convert", "resize")
+
+    def __init__(self):
+        self.count = 0
+        # nested calls, an allocation is only counted once
+        self.depth = 0
+        self.saved = []
+
+    def wrap(self, owner, name):
+        f = getattr(owner, name)
+
+        def counted(*args, **kwargs):
+            # asarray of an array is a view
+            if not (name == "asarray" and isinstance(args[0], np.ndarray)):
+                if not self.depth:
+                    self.count += 1
+            self.depth += 1
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        self.saved.append((owner, name, f))
+        setattr(owner, name, counted)
+
+    def install(self):
+        for name in self.NUMPY:
+            self.wrap(np, name)
+        for name in self.PIL:
+            self.wrap(Image, name)
+        for name in self.IMAGE:
+            self.wrap(Image.Image, name)
+
+    def uninstall(self):
+        for owner, name, f in reversed(self.saved):
+            setattr(owner, name, f)
+        self.saved = []
+
+
+allocations = Allocations()
+
+
+class Stage(object):
+    """Samples of one pipeline stage"""
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.allocs = []
+        self.gc_objects = []
+        self.bytes = []
+        self.spi_times = []
+
+    def run(self, spi, f, *args):
+        spi_before = spi.stats()
+        gen0 = gc.get_count()[0]
+        allocs = allocations.count
+        start = timer()
+        f(*args)
+        elapsed = timer() - start
+        self.allocs.append(allocations.count - allocs)
+        self.gc_objects.append(gc.get_count()[0] - gen0)
+        spi_after = spi.stats()
+        self.times.append(elapsed)
+        self.bytes.append(spi_after["bytes"] - spi_before["bytes"])
+        self.spi_times.append(spi_after["elapsed"] - spi_before["elapsed"])
+        return elapsed
+
+    def report(self):
+        n = float(max(len(self.times), 1))
+        return {
+            "samples": len(self.times),
+            "p50_ms": percentile(self.times, 50) * 1000,
+            "p99_ms": percentile(self.times, 99) * 1000,
+            "max_ms": max(self.times or [0]) * 1000,
+            "allocs_per_frame": sum(self.allocs) / n,
+            "gc_objects_per_frame": sum(self.gc_objects) / n,
+            "bytes_per_frame": sum(self.bytes) / n,
+            "spi_model_ms": sum(self.spi_times) / n * 1000,
+        }
+
+
+class Bench(object):
+    """Run the Clock frame pipeline"""
+    FRAME_STAGES = ("clear", "compose", "d_menu", "display")
+    WIDGETS = ("d_clock", "d_date", "d_mplayer", "d_signal", "d_temp",
+               "d_audio", "d_alarm", "d_cpu")
+    CONVERSIONS = tuple("rgb565_" + mode for mode in rgb565.MODES)
+    STAGES = FRAME_STAGES + WIDGETS + CONVERSIONS
+
+    def __init__(self, seed=0):
+        stub_sources()
+        self.random = random.Random(seed)
+        self.oled = ssd1351.SSD1351(reset_pin=15, dc_pin=16, rows=96,
+                                    backend="sim")
+        self.clk = clock.Clock(self.oled)
+        self.clk.alarm = "07:00"
+        self.stages = dict((name, Stage(name)) for name in self.STAGES)
+        self.frames = Stage("frame")
+        self.scratch = self.oled.im.copy()
+
+    def stage(self, name, *args):
+        f = getattr(self.clk, name) if hasattr(self.clk, name) else \
+            getattr(self.oled, name)
+        return self.stages[name].run(self.oled.spi, f, *args)
+
+    def update_sources(self, i):
+        """Publish new values, as the worker threads would"""
+        bus = events.bus
+        bus.publish(events.CPU, self.random.randint(0, 100))
+        if i % 5 == 0:
+            bus.publish(events.WIFI, self.random.randint(0, 99))
+        if i % 50 == 0:
+            bus.publish(events.TEMP, 18 + self.random.random() * 6)
+        if i % 20 == 0:
+            bus.publish(events.VOLUME, self.random.randint(0, 100))
+        if i % 100 == 0:
+            bus.publish(events.PLAYER,
+                        ("play", "Track %d - Artist %d" % (i, i)))
+        bus.drain()
+
+    def frame(self, i, menu=False):
+        names = ["clear"]
+        self.stage("clear")
+        if menu:
+            names.append("d_menu")
+            self.stage("d_menu", False, 1)
+        else:
+            self.clk.in_menu = False
+        for name in ("compose", "display"):
+            names.append(name)
+            self.stage(name)
+        stages = [self.stages[name] for name in names]
+        self.frames.times.append(sum(s.times[-1] for s in stages))
+        self.frames.allocs.append(sum(s.allocs[-1] for s in stages))
+        self.frames.gc_objects.append(sum(s.gc_objects[-1] for s in stages))
+        self.frames.bytes.append(sum(s.bytes[-1] for s in stages))
+        self.frames.spi_times.append(sum(s.spi_times[-1] for s in stages))
+
+    def widgets(self):
+        """Time every painter alone, off the display buffer"""
+        with self.oled.target(self.scratch):
+            for layer in self.clk.layers.layers.values():
+                for w in layer.widgets:
+                    name = w.paint.__name__
+                    if name not in self.WIDGETS:
+                        continue
+                    args = () if w.source is None else (w.source(),)
+                    self.stage(name, *args)
+
+    def conversions(self):
+        """Time every RGB565 conversion mode on the full frame"""
+        frame = np.array(self.oled.im)
+        for mode in rgb565.MODES:
+            self.stages["rgb565_" + mode].run(
+                self.oled.spi, self.oled.converter.convert, frame, (0, 0),
+                mode)
+
+    def run(self, frames, menu_every=10):
+        gc.collect()
+        gc.disable()
+        allocations.install()
+        try:
+            for i in range(frames):
+                self.update_sources(i)
+                self.frame(i, menu=menu_every and i % menu_every == 0)
+                if not self.clk.in_menu:
+                    self.widgets()
+                self.conversions()
+                gc.collect()
+        finally:
+            allocations.uninstall()
+            gc.enable()
+
+    def report(self):
+        return {
+            "meta": {
+                "date": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "node": platform.node(),
+                "spi_hz": self.oled.spi.max_speed_hz,
+            },
+            "frame": self.frames.report(),
+            "stages": dict((name, stage.report())
+                           for name, stage in self.stages.items()),
+        }
+
+
+def glyph_cases(clk):
+    """(atlas, strings) the clock draws, and the song titles"""
+    day = datetime.date(2024, 1, 1)
+    dates = [(day + datetime.timedelta(days=i)).strftime("%a %d %b")
+             .decode("utf-8") for i in range(366)]
+    return [
+        (clk.glyph_clk, [u"%02d:%02d" % (h, m)
+                         for h in range(24) for m in range(60)]),
+        (clk.glyph_date, dates),
+        (clk.glyph_temp, [u"%.1f'C" % (t / 10.0) for t in range(-200, 500)]),
+        (clk.glyph_vol, [u"%s %%" % v for v in range(101)]),
+        (glyphs.GlyphAtlas(clk.font_txt),
+         [u"Some Song - Some Artist", u"Track 42 - Artist 42",
+          u"Daft Punk - Harder, Better, Faster, Stronger"]),
+    ]
+
+
+def check_glyphs(clk):
+    """Print the strings the atlases draw unlike ImageDraw.text,
+       return how many"""
+    failed = 0
+    for atlas, texts in glyph_cases(clk):
+        for text in texts:
+            diff = glyphs.check(atlas, text)
+            if diff:
+                failed += 1
+                print "%r: %d pixels differ" % (text, diff)
+    return failed
+
+
+def print_report(report, previous=None):
+    cols = ("p50_ms", "p99_ms", "allocs_per_frame", "gc_objects_per_frame",
+            "bytes_per_frame")
+    print "%-14s %9s %9s %9s %9s %9s" % (("stage",) + cols[:2] +
+                                         ("allocs", "gc_objs", "bytes"))
+    rows = [(name, report["stages"][name]) for name in Bench.STAGES]
+    rows.append(("frame", report["frame"]))
+    for name, stage in rows:
+        line = "%-14s %9.3f %9.3f %9.1f %9.1f %9.0f" % (
+            (name,) + tuple(stage[c] for c in cols))
+        if previous is not None:
+            old = previous["stages"].get(name, previous["frame"]
+                                         if name == "frame" else None)
+            if old and old["p50_ms"]:
+                line += "  p50 %+.0f%%" % (
+                    (stage["p50_ms"] / old["p50_ms"] - 1) * 100)
+        print line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--frames', type=int, default=300,
+                        help='number of frames to render')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('--compare', help='previous JSON results')
+    parser.add_argument('--budget', type=float, default=FRAME_BUDGET,
+                        help='frame budget in seconds')
+    parser.add_argument('--convert', choices=rgb565.MODES,
+                        help='RGB565 conversion mode of the frames')
+    parser.add_argument('--check-glyphs', action='store_true',
+                        help='compare the glyph atlases with ImageDraw.text')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    bench = Bench()
+    if args.check_glyphs:
+        failed = check_glyphs(bench.clk)
+        print "glyphs: %d strings differ" % failed
+        sys.exit(1 if failed else 0)
+    if args.convert:
+        bench.oled.converter.mode = args.convert
+    bench.run(args.frames)
+    report = bench.report()
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if report["frame"]["max_ms"] > args.budget * 1000:
+        print "frame over budget: %.1fms" % report["frame"]["max_ms"]
+        sys.exit(1)
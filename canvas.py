@@ -0,0 +1,223 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Native RGB565 drawing surface
+#
+# The pixels are kept as 16 bits big endian values, the SSD1351 RAM
+# format: the framebuffer is sent as is, with no RGB888 image to convert
+# on every frame (2 bytes per pixel instead of 3, plus the conversion
+# buffers).
+#
+# Colours are anything PIL understands ("#009900", "red", (r, g, b)...),
+# rounded to the nearest RGB565 level. Antialiased text is blended in
+# RGB565 space.
+# ----------------------------------------------------------------------
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+import glyphs
+import rgb565
+
+# 8 bits value to 5 and 6 bits levels
+LEVELS5 = rgb565.levels(5, 0.5)
+LEVELS6 = rgb565.levels(6, 0.5)
+
+WIRE = np.dtype(">u2")
+# red, green and blue fields of a RGB565 value
+SHIFTS = np.array([11, 5, 0], np.int32)
+TOPS = np.array([0x1F, 0x3F, 0x1F], np.int32)
+
+
+def pack(array):
+    """RGB888 (..., 3) uint8 array to RGB565 values"""
+    return ((LEVELS5[array[..., 0]] << 11) | (LEVELS6[array[..., 1]] << 5) |
+            LEVELS5[array[..., 2]]).astype(WIRE)
+
+
+class Canvas(object):
+    """RGB565 framebuffer with a few drawing primitives
+
+       Boxes are (x0, y0, x1, y1) with x1 and y1 included, like
+       ImageDraw.rectangle."""
+
+    def __init__(self, cols, rows):
+        self.size = (cols, rows)
+        self.buf = np.zeros((rows, cols), WIRE)
+        self.colors = {}
+        # coverage of the glyphs, by (atlas, char)
+        self.glyphs = {}
+
+    @property
+    def nbytes(self):
+        return self.buf.nbytes
+
+    def wire(self):
+        """The pixels as bytes in panel order"""
+        return self.buf.view(np.uint8).ravel()
+
+    def color(self, color):
+        """RGB565 value of a PIL colour"""
+        value = self.colors.get(color)
+        if value is None:
+            if isinstance(color, (int, long)):
+                rgb = ((color >> 16) & 0xFF, (color >> 8) & 0xFF,
+                       color & 0xFF)
+            else:
+                rgb = ImageColor.getrgb(color)[:3]
+            value = int(pack(np.array(rgb, np.uint8)))
+            self.colors[color] = value
+        return value
+
+    def clip(self, x0, y0, x1, y1):
+        """Clip a box to the canvas, None if nothing is left"""
+        cols, rows = self.size
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), cols - 1), min(int(y1), rows - 1)
+        if x1 < x0 or y1 < y0:
+            return None
+        return x0, y0, x1, y1
+
+    def fill(self, color, box=None):
+        if box is None:
+            self.buf.fill(self.color(color))
+            return
+        box = self.clip(*box)
+        if box is not None:
+            x0, y0, x1, y1 = box
+            self.buf[y0:y1+1, x0:x1+1] = self.color(color)
+
+    def rectangle(self, box, fill=None, outline=None):
+        if len(box) == 2:
+            box = tuple(box[0]) + tuple(box[1])
+        x0, y0, x1, y1 = box
+        if fill is not None:
+            self.fill(fill, box)
+        if outline is not None:
+            for edge in ((x0, y0, x1, y0), (x0, y1, x1, y1),
+                         (x0, y0, x0, y1), (x1, y0, x1, y1)):
+                self.fill(outline, edge)
+
+    def line(self, xy, fill):
+        """Line from xy[0] to xy[1], both ends included"""
+        (x0, y0), (x1, y1) = xy
+        if x0 == x1 or y0 == y1:
+            self.fill(fill, (min(x0, x1), min(y0, y1),
+                             max(x0, x1), max(y0, y1)))
+            return
+        n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        xs = np.rint(np.linspace(x0, x1, n)).astype(int)
+        ys = np.rint(np.linspace(y0, y1, n)).astype(int)
+        cols, rows = self.size
+        inside = (xs >= 0) & (xs < cols) & (ys >= 0) & (ys < rows)
+        self.buf[ys[inside], xs[inside]] = self.color(fill)
+
+    def blit(self, src, xy, alpha=False):
+        """Copy `src` at `xy`: a Canvas, an array of RGB565 values or a
+           PIL image, blended by its transparency if `alpha` is set"""
+        if isinstance(src, Canvas):
+            src = src.buf
+        elif isinstance(src, Image.Image):
+            if alpha:
+                src = src.convert("RGBA")
+                alpha = np.asarray(src)[..., 3]
+            src = pack(np.asarray(src.convert("RGB")))
+        x, y = int(xy[0]), int(xy[1])
+        if alpha is not False:
+            self.paint(self.coverage(alpha), (x, y), src)
+            return
+        h, w = src.shape
+        box = self.clip(x, y, x + w - 1, y + h - 1)
+        if box is None:
+            return
+        x0, y0, x1, y1 = box
+        self.buf[y0:y1+1, x0:x1+1] = src[y0-y:y1-y+1, x0-x:x1-x+1]
+
+    def paste_mask(self, mask, xy, color):
+        """Paint `color` through `mask` (an "L" image or uint8 array)
+           at `xy`, the way glyphs are drawn"""
+        self.paint(self.coverage(mask), xy, self.color(color))
+
+    @staticmethod
+    def coverage(mask):
+        """Pixels covered by an "L" mask, as ((ys, xs), (ys, xs, alpha))
+           for the opaque and the partially covered ones"""
+        mask = np.asarray(mask)
+        oy, ox = np.nonzero(mask == 255)
+        py, px = np.nonzero((mask > 0) & (mask < 255))
+        return (oy, ox), (py, px, mask[py, px].astype(np.int32))
+
+    def paint(self, coverage, xy, src):
+        """Paint `src` (RGB565 value, or array the size of the mask)
+           over the pixels of `coverage` at `xy`"""
+        x, y = int(xy[0]), int(xy[1])
+        src = np.asarray(src)
+        (oy, ox), (py, px, a) = coverage
+        cols, rows = self.size
+        for ys, xs, alpha in ((oy, ox, None), (py, px, a)):
+            if not ys.size:
+                continue
+            fg = src if src.ndim == 0 else src[ys, xs]
+            ys = ys + y
+            xs = xs + x
+            if y < 0 or x < 0 or ys[-1] >= rows or xs.max() >= cols:
+                inside = (ys >= 0) & (ys < rows) & (xs >= 0) & (xs < cols)
+                ys, xs = ys[inside], xs[inside]
+                if src.ndim:
+                    fg = fg[inside]
+                if alpha is not None:
+                    alpha = alpha[inside]
+            if alpha is None:
+                self.buf[ys, xs] = fg
+            else:
+                self.buf[ys, xs] = self.mix(self.buf[ys, xs], fg, alpha)
+
+    @staticmethod
+    def mix(bg, fg, alpha):
+        """Blend RGB565 values `fg` over `bg` by `alpha` (0-255)"""
+        b = (bg.astype(np.int32)[:, None] >> SHIFTS) & TOPS
+        f = (np.asarray(fg, np.int32)[..., None] >> SHIFTS) & TOPS
+        out = b + ((f - b) * alpha[:, None] + 127) // 255
+        return (out << SHIFTS).sum(axis=1)
+
+    def textsize(self, text, font):
+        if isinstance(font, glyphs.GlyphAtlas):
+            return font.textsize(text)
+        return font.getsize(text)
+
+    def text(self, xy, text, fill, font):
+        """Draw `text` with a PIL font or a GlyphAtlas,
+           return the text size"""
+        x, y = xy
+        if not isinstance(font, glyphs.GlyphAtlas):
+            mask = Image.new("L", font.getsize(text))
+            ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+            self.paste_mask(mask, (x, y), fill)
+            return mask.size
+        x0 = x
+        h = w = 0
+        value = self.color(fill)
+        prev = None
+        for char in text:
+            if prev is not None:
+                x += font.offset(prev, char)
+            mask, (dx, dy), (w, ch) = font.glyph(char)
+            h = max(h, ch)
+            if mask is not None:
+                h = max(h, dy + mask.size[1])
+                coverage = self.glyphs.get((font, char))
+                if coverage is None:
+                    coverage = self.coverage(mask)
+                    self.glyphs[(font, char)] = coverage
+                self.paint(coverage, (x + dx, y + dy), value)
+            prev = char
+        return x + w - x0, h
+
+    def to_image(self):
+        """The canvas as a PIL RGB image"""
+        v = self.buf.astype(np.uint16)
+        rgb = np.empty(v.shape + (3,), np.uint8)
+        rgb[..., 0] = (v >> 8) & 0xF8
+        rgb[..., 1] = (v >> 3) & 0xFC
+        rgb[..., 2] = (v << 3) & 0xF8
+        return Image.fromarray(rgb, "RGB")
@@ -3,23 +3,46 @@
 
 import datetime
 import time
+import math
 import ssd1351
 import random
+import numpy as np
 from PIL import Image, ImageFont
-import psutil
 import logging
 import os
 import locale
 import th
 import threading
 import menu
+import fonts
+import glyphs
+import compositor
+import events
+import ticker
+import metrics
+import tracing
+import tools
+import history
+
+RENDER_TIME = metrics.histogram(
+    "pioclock_render_seconds", "Time to draw a frame")
+SLEEP_JITTER = metrics.histogram(
+    "pioclock_sleep_jitter_seconds",
+    "Main loop wake up delay after a timed deadline",
+    (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+INPUT_LATENCY = metrics.histogram(
+    "pioclock_input_latency_seconds",
+    "Time from an input event to its frame sent to the display")
 
 __VERSION__ = "0.6"
 log = logging.getLogger("main")
 logging.basicConfig(
     format='%(asctime)-23s - %(levelname)-7s - %(name)s - %(message)s')
 log.setLevel(logging.INFO)
-locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
+try:
+    locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
+except locale.Error, e:
+    log.warning("locale: %s" % e)
 path, filename = os.path.split(os.path.abspath(__file__))
 op = os.path
 
@@ -30,15 +53,35 @@ class Clock(object):
     alarm_running = False
     B_FULL = 200
     B_DIMMED = 25
+    # let the panel scroll song titles fitting on screen
+    HW_SCROLL = True
+    # title ticker band, (top, rows)
+    TICKER_BAND = (73, 22)
+    # refresh rate: frames per second while the title scrolls, else
+    # every second for the blinking colon, or every minute without it
+    SCROLL_FPS = 20
+    BLINK_COLON = True
+    # share of the CPU time periodic frames may take
+    CPU_BUDGET = 0.3
 
     def __init__(self, oled):
         self.log = logging.getLogger(self.__class__.__name__)
         self.log.setLevel(logging.DEBUG)
         # OLED display
+        if oled.native:
+            # the layers and painters use ImageDraw and RGBA compositing
+            raise ValueError("Clock draws with PIL, it cannot use a "
+                             "SSD1351(native=True) display")
         self.oled = oled
-        self.font_clk = ImageFont.truetype(op.join(path, "lcd.ttf"), 58)
-        self.font_txt = ImageFont.truetype(op.join(path, "vermin_vibes_1989.ttf"), 20)
-        self.font_big = ImageFont.truetype(op.join(path, "wendy.ttf"), 70)
+        self.font_clk = fonts.get(op.join(path, "lcd.ttf"), 58)
+        self.font_txt = fonts.get(op.join(path, "vermin_vibes_1989.ttf"), 20)
+        self.font_big = fonts.get(op.join(path, "wendy.ttf"), 70)
+        # pre-rasterised glyphs for the text redrawn every second
+        self.glyph_clk = glyphs.atlas(self.font_clk, glyphs.DIGITS + u":")
+        self.glyph_date = glyphs.atlas(fonts.get(op.join(path, "wendy.ttf"), 14))
+        self.glyph_temp = glyphs.atlas(fonts.get(op.join(path, "wendy.ttf"), 20),
+                                       glyphs.DIGITS + u".-'C")
+        self.glyph_vol = glyphs.atlas(self.font_big, glyphs.DIGITS + u" %")
         # self.tick = True
         self.oled.reset()
         self.oled.begin()
@@ -50,7 +93,18 @@ class Clock(object):
         self.oled.display()
         self.oled.set_contrast(self.B_FULL)
         self.clear = self.oled.clear
-        self.display = self.oled.display
+        # damaged areas of the frame, None for the whole screen
+        self.damage = None
+        # time.time() the menu or volume screen ends
+        self.mode_end = 0
+        # average frame processing time, in seconds
+        self.frame_cost = 0
+        self.sched = events.Scheduler(events.bus, SLEEP_JITTER)
+        # cpu, wifi and temperature history, see d_history
+        self.history = history.Store()
+        if history.PATH:
+            self.history.load(history.PATH)
+        self.history.subscribe()
         # wifi signal ressourses
         self.signal = [
             Image.open(op.join(path, "radio_0.png")),
@@ -58,9 +112,10 @@ class Clock(object):
             Image.open(op.join(path, "radio_2.png")),
             Image.open(op.join(path, "radio_3.png"))]
         self.alarm_img = Image.open(op.join(path, "alarm.png"))
-        # scrolling text settings
-        self.scroll_txt = oled.cols
+        # scrolling text settings, in px/s
         self.SCROLLING_SPEED = 8
+        self.ticker = ticker.Ticker(oled.cols, self.font_txt,
+                                    self.SCROLLING_SPEED)
         # current time
         self.now = datetime.datetime.now()
 
@@ -104,8 +159,12 @@ class Clock(object):
         w, h = self.oled.draw_text(0, title_y, "Audio", "white", size=size)
         self.display()
         self.audio_thread = th.Audio()
-        self.audio_thread.start()
-        self.oled.draw_text(a_right, title_y, "OK", "green", size=size)
+        try:
+            self.audio_thread.start()
+            self.oled.draw_text(a_right, title_y, "OK", "green", size=size)
+        except Exception, e:
+            self.log.error("no mixer: %s" % e)
+            self.oled.draw_text(a_right, title_y, "KO", "red", size=size)
         self.display()
         title_y += size + 2
 
@@ -133,6 +192,7 @@ class Clock(object):
                              menu.SubMenu("playlist", self.menu_playlist()),
                          ]),
             menu.Screen("info", self.d_info),
+            menu.Screen("history", self.d_history),
 	    menu.Action("alarm 5h00", self.alarm_on, arg="04:45", goback=True),
 	    menu.Action("alarm 6h15", self.alarm_on, arg="06:15", goback=True),
             menu.Action("alarm 7h00", self.alarm_on, arg="07:00", goback=True),
@@ -143,13 +203,22 @@ class Clock(object):
         self.menu_sub = []
         self.menu_cursor = 0
         self.menu_max_items = 5
+        self.init_layers()
 
     def stop_all(self):
         self.log.debug("stopping all thread...")
+        for source in ("mpd_thread", "hwm_thread", "audio_thread",
+                       "input_thread"):
+            source = getattr(self, source, None)
+            if isinstance(source, th.Source):
+                source.stop()
         for thread in threading.enumerate():
             # self.log.debug("send stop to  %s" % thread.__class__.__name__)
             if thread.__class__.__name__ in ("_MainThread", "_DummyThread"):
                 continue
+            if not hasattr(thread, "stop"):
+                # a library thread, left to end with the process
+                continue
             thread.stop()
         # for thread in threading.enumerate():
         #     if thread.name == "MainThread":
@@ -157,25 +226,231 @@ class Clock(object):
         #     thread.join()
         self.log.debug("stopping all thread complete!")
 
-    def d_clock(self):
-        if self.in_menu or self.in_volume:
-            return
+    def init_layers(self):
+        """Split the main screen in cached layers, from bottom to top,
+           made of widgets repainted when their source value changes"""
+        W = compositor.Widget
+        cols = self.oled.cols
+        self.layers = compositor.Compositor(self.oled)
+        self.layers.add_layer("background", [
+            W("volume_frame", (44, 3, 85, 6), None, self.d_audio_frame)])
+        self.layers.add_layer("status", [
+            W("signal", (0, 0, 16, 16), self.wifi_level, self.d_signal),
+            W("alarm", (23, 0, 39, 16), self.alarm_set, self.d_alarm),
+            W("date", (32, 12, cols, 24), self.date_text, self.d_date),
+            W("temp", (82, 0, cols, 10), self.temperature, self.d_temp),
+            W("volume", (44, 3, 85, 6), self.volume_level, self.d_audio)])
+        self.layers.add_layer("clock", [
+            W("clock", (0, 24, cols, 72), self.clock_face, self.d_clock)])
+        self.layers.add_layer("overlay", [
+            W("title", (0, 73, cols, 95), self.player_state, self.d_mplayer),
+            W("cpu", (0, 95, cols, 96), self.cpu_load, self.d_cpu)],
+            volatile=True)
+        self.mode = None
+
+    # widget sources, the latest values published on the event bus
+
+    def wifi_level(self):
+        return int(events.bus.latest(events.WIFI, 0) / 100.0 * 4)
+
+    def alarm_set(self):
+        return self.alarm != ""
+
+    def date_text(self):
+        return self.now.strftime("%a %d %b").decode("utf-8")
+
+    def temperature(self):
+        if not hasattr(self, "temp_node"):
+            return None
+        return events.bus.latest(events.TEMP, 0)
+
+    def volume_level(self):
+        return events.bus.latest(events.VOLUME, 0)
+
+    def clock_face(self):
+        return (self.now.strftime("%H:%M"),
+                self.BLINK_COLON and self.now.second % 2 > 0)
+
+    def player_state(self):
+        state, title = events.bus.latest(events.PLAYER, ("stop", ""))
+        offset = None
+        if state == "play" and len(title) > 0:
+            self.ticker.set_text(title)
+            if self.hw_ticker():
+                # drawn once at the left edge, the panel scrolls it
+                offset = self.oled.cols
+            else:
+                offset = self.ticker.position()
+        else:
+            # reset scrolling
+            self.ticker.reset()
+        return state, title, offset
+
+    def cpu_load(self):
+        return events.bus.latest(events.CPU, 0)
+
+    def loop(self):
+        """Main loop: sleep until an event or a deadline, then render
+
+           The clock is redrawn on every second, or as soon as a worker
+           thread publishes something. Menu and volume screens stay until
+           no input came for 1 + self.freeze seconds."""
+        sched = self.sched
+        self.mode_end = 0
+        while True:
+            if self.in_menu or self.in_volume:
+                sched.at("tick", self.mode_end)
+            else:
+                sched.at("tick", self.next_frame(time.time()))
+            alarm = self.next_alarm()
+            if alarm is None:
+                sched.cancel(events.ALARM)
+            else:
+                sched.at(events.ALARM, alarm)
+
+            changes = sched.wait()
+            start = time.time()
+            with tracing.span("frame"):
+                self.update(changes, start)
+
+            d = time.time() - start
+            self.frame_cost += (d - self.frame_cost) * 0.1
+            if d > 0.5:
+                self.log.info("process: %.4f overhead!" % d)
+                try:
+                    tracing.tracer.dump_overrun(d)
+                except Exception, e:
+                    self.log.error("cannot dump trace: %s" % e)
+
+    def refresh_interval(self):
+        """Seconds between periodic frames, for what is on screen"""
+        if self.ticker.text is not None and not self.hw_ticker():
+            # the title scrolls
+            return 1.0 / self.SCROLL_FPS
+        if self.BLINK_COLON:
+            return 1
+        return 60
+
+    def next_frame(self, now):
+        """time.time() of the next periodic frame: on the next second
+           or minute, or in 1/SCROLL_FPS seconds while scrolling,
+           slowed down to fit in CPU_BUDGET"""
+        interval = self.refresh_interval()
+        if interval >= 1:
+            return (math.floor(now / interval) + 1) * interval
+        return now + max(interval, self.frame_cost / self.CPU_BUDGET)
+
+    def update(self, changes, start):
+        """Render a frame for the (topic, value) events in changes"""
+        topics = set(topic for topic, value in changes)
+        for topic, value in changes:
+            if topic == events.CLOCK:
+                self.log.info("wall clock stepped by %+.3fs" % value)
+                self.mode_end += value
+        inputs = [value for topic, value in changes
+                  if topic == events.INPUT and value is not None]
+        if events.ALARM in topics:
+            self.now = datetime.datetime.now()
+            self.check_alarm()
+        if events.INPUT in topics:
+            self.clear()
+            if self.handle_input():
+                self.mode_end = time.time() + 1 + self.freeze
+        elif self.in_menu or self.in_volume:
+            if "tick" not in topics:
+                return
+            # no input for a while, back to the clock
+            self.in_menu = False
+            self.in_volume = False
+            self.freeze = 0
+            self.clear()
+        else:
+            self.clear()
+        with tracing.span("compose"):
+            self.compose()
+        RENDER_TIME.observe(time.time() - start)
+        done = None
+        if inputs:
+            first = min(inputs)
+            done = lambda: INPUT_LATENCY.observe(tools.monotonic() - first)
+        with tracing.span("display"):
+            self.display(done)
+
+    def handle_input(self):
+        """Apply the wheel and clicks accumulated by the input thread,
+           return True if something was drawn"""
+        with self.input_thread.lock:
+            wheel = self.input_thread.wheel
+            steps = self.input_thread.steps
+            click = self.input_thread.click
+            self.input_thread.wheel = 0
+            self.input_thread.steps = 0
+            self.input_thread.click = False
+            self.input_thread.has_input.clear()
+        if wheel != 0 and not self.in_menu:
+            new_vol = events.bus.latest(events.VOLUME, 0) + wheel
+            self.d_volume(new_vol)
+        elif click or steps != 0:
+            # no acceleration through the menu entries
+            self.d_menu(click, steps)
+        else:
+            return False
+        return True
+
+    def next_alarm(self):
+        """time.time() of the next alarm, None if there is none"""
+        if self.alarm == "":
+            return None
+        hour, minute = [int(v) for v in self.alarm.split(":")]
         now = datetime.datetime.now()
-        font = ImageFont.truetype(op.join(path, "wendy.ttf"), 14)
-        self.oled.text_center(now.strftime("%H:%M"), "#3333cc", font=self.font_clk)
-        date = now.strftime("%a %d %b")
-        w, h = self.oled.draw.textsize(date, font=font)
+        alarm = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if alarm <= now:
+            alarm += datetime.timedelta(days=1)
+        return time.mktime(alarm.timetuple())
 
-        self.oled.draw_text(self.oled.cols - w, 12, date, "#3333cc", font=font)
+    def compose(self):
+        """Draw the main screen over the display buffer"""
+        self.now = datetime.datetime.now()
+        self.check_alarm()
+        mode = (self.in_menu, self.in_volume)
+        if mode != self.mode:
+            self.mode = mode
+            self.layers.invalidate()
+        if self.in_menu:
+            self.layers.render(["overlay"])
+            self.damage = None
+        else:
+            damage = self.layers.render()
+            # the volume screen is drawn outside of the widgets
+            self.damage = None if self.in_volume else damage
+
+    def display(self, done=None):
+        """Send the frame, only the damaged areas after compose(),
+           done() is called once it is on the panel"""
+        self.oled.display(regions=self.damage, done=done)
+        self.damage = None
+
+    def d_clock(self, face):
+        if self.in_menu or self.in_volume:
+            return
+        hour, blink = face
+        self.oled.text_center(hour, "#3333cc", font=self.glyph_clk)
 
-        if now.second % 2 > 0:
+        if blink:
             self.oled.draw.rectangle([(58, 37), (67, 60)], fill="#000000")
-        self.now = now
 
-    def d_alarm(self):
-        if self.alarm != "":
+    def d_date(self, date):
+        if self.in_menu or self.in_volume:
+            return
+        w, h = self.oled.textsize(date, self.glyph_date)
+        self.oled.draw_text(self.oled.cols - w, 12, date, "#3333cc", font=self.glyph_date)
+
+    def d_alarm(self, alarm_set):
+        if alarm_set:
             self.oled.im.paste(self.alarm_img, (23 ,0))
-            # check alarm
+
+    def check_alarm(self):
+        if self.alarm != "":
             if not self.alarm_running and self.now.strftime("%H:%M") == self.alarm:
                 # wake up!
                 self.log.info("Wake up !")
@@ -196,17 +471,11 @@ class Clock(object):
                 self.mpd_thread.stop_playing()
                 self.alarm_running = False
 
-    def d_signal(self):
-        """get signal power and display it on screen"""
-        with self.hwm_thread.lock:
-            wifi = self.hwm_thread.wifi_signal
-        signal = int(wifi / 100.0 * 4)
-        self.oled.im.paste(self.signal[signal], (0, 0))
-
-    def d_cpu(self):
-        self.hwm_thread.lock.acquire()
-        cpu = self.hwm_thread.cpu
-        self.hwm_thread.lock.release()
+    def d_signal(self, signal):
+        """display signal power on screen"""
+        self.oled.im.paste(self.signal[min(signal, 3)], (0, 0))
+
+    def d_cpu(self, cpu):
         cpu_bar = cpu / 100.0 * self.oled.cols
         cpu_color = "#003300"
         if cpu > 50:
@@ -215,21 +484,28 @@ class Clock(object):
             cpu_color = "#330000"
         self.oled.draw.line([(0, 95), (cpu_bar, 95)], fill=cpu_color)
 
-    def d_mplayer(self):
+    def hw_ticker(self):
+        """True if the panel can scroll the title itself: the scrolled
+           band wraps around the screen width, the title must fit in"""
+        return self.HW_SCROLL and self.ticker.text is not None and \
+            self.ticker.period <= 2 * self.oled.cols
+
+    def d_mplayer(self, player):
         if self.in_menu or self.in_volume:
+            self.oled.stop_scroll()
             return
-        # refresh every minute
-        self.mpd_thread.lock.acquire()
-        status = self.mpd_thread.status
-        title = self.mpd_thread.title
-        self.mpd_thread.lock.release()
-
-        if status['state'] == "play":
-            if len(title) > 0:
-                t_w, t_h = self.oled.draw_text(self.scroll_txt, 73, title, "#009900", font=self.font_txt)
-                self.scroll_txt -= self.SCROLLING_SPEED
-                if self.scroll_txt <= 0 - self.SCROLLING_SPEED - t_w:
-                    self.scroll_txt = self.oled.cols
+        state, title, offset = player
+
+        if state == "play" and offset is not None and self.hw_ticker():
+            top, rows = self.TICKER_BAND
+            self.oled.scroll_rows(top, rows, step=-1,
+                                  interval=self.oled.SCROLL_NORMAL)
+        else:
+            self.oled.stop_scroll()
+        if state == "play":
+            if offset is not None:
+                self.ticker.draw(self.oled.im, (0, self.TICKER_BAND[0]),
+                                 "#009900", offset)
             # draw play icon here...
             if self.oled.contrast != self.B_FULL:
                 self.oled.set_contrast(self.B_FULL)
@@ -238,24 +514,19 @@ class Clock(object):
             # alarm is not running anymore (if any)
             if self.alarm_running and self.now.strftime("%H:%M") != self.alarm:
                 self.alarm_running = False
-            # reset scrolling
-            self.scroll_txt = self.oled.cols
             if self.oled.contrast != self.B_DIMMED:
                 self.oled.set_contrast(self.B_DIMMED)
 
-    def d_temp(self):
-        self.temp_node.lock.acquire()
-        tempC = "%.1f'C" % self.temp_node.temp
-        self.temp_node.lock.release()
-        font = ImageFont.truetype(op.join(path, "wendy.ttf"), 20)
-        w, h = self.oled.draw.textsize(tempC, font=font)
-        self.oled.draw_text(self.oled.cols - w +2, -4, tempC, "#666666", font=font)
-
-    def d_audio(self):
-        with self.audio_thread.lock:
-            volume = self.audio_thread.volume
+    def d_temp(self, temp):
+        tempC = u"%.1f'C" % temp
+        w, h = self.oled.textsize(tempC, self.glyph_temp)
+        self.oled.draw_text(self.oled.cols - w +2, -4, tempC, "#666666", font=self.glyph_temp)
+
+    def d_audio_frame(self):
         # background
         self.oled.draw.rectangle([(44, 3), (84, 5)], fill="#000000", outline="#333333")
+
+    def d_audio(self, volume):
         volume_bar = volume / 100.0 * 40
         self.oled.draw.rectangle([(44, 3), (44+volume_bar, 5)], fill="#006600")
 
@@ -267,7 +538,7 @@ class Clock(object):
             self.oled.set_contrast(self.B_FULL)
         new_vol = min(max(vol, 0), 100)
         self.oled.text_center_y(15, "volume", "#006600", font=self.font_txt)
-        self.oled.text_center_y(25, "%s %%" % (new_vol,), "#3333cc", font=self.font_big)
+        self.oled.text_center_y(25, u"%s %%" % (new_vol,), "#3333cc", font=self.glyph_vol)
         self.freeze = 2
 
     def d_menu(self, click=False, pos=0):
@@ -322,7 +593,7 @@ class Clock(object):
         self.oled.text_center_y(0, "M E N U", "#D93BD6", font=self.font_txt)
         self.menu_cursor = (self.menu_cursor + pos) % len(cur_menu)
         # self.log.debug("menu cursor: %s" % self.menu_cursor)
-        font = ImageFont.truetype("/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf", 14)
+        font = fonts.get(fonts.DROID_FALLBACK, 14)
 
         cursor = self.menu_cursor
         offset = max(0, cursor - (self.menu_max_items-1))
@@ -364,7 +635,7 @@ class Clock(object):
             self.oled.text_center_y(0, "info", "#D93BD6", font=self.font_txt)
             ip = self.hwm_thread.get_ip_address('wlan0')
 	    if ip:
-                essid = self.hwm_thread.wifi.getEssid()
+                essid = self.hwm_thread.essid()
                 with self.hwm_thread.lock:
                     signal = self.hwm_thread.wifi_signal
 		netcolor = "#00ff00"
@@ -391,6 +662,49 @@ class Clock(object):
             self.display()
             self.input_thread.has_input.wait(30)
 
+    def d_history(self):
+        """Sparklines of the temperature, cpu load and wifi signal"""
+        # (series, label, colour, tier, seconds shown)
+        graphs = [("cpu", "cpu 1h", "#00cc00", history.MINUTE, 3600),
+                  ("wifi", "wifi 24h", "#3b8bd6", history.MINUTE, 24*3600)]
+        if hasattr(self, "temp_node"):
+            graphs.insert(0, ("temp/%s" % self.temp_node.device, "temp 7d",
+                              "#cc6600", history.QUARTER, 7*24*3600))
+        while not self.input_thread.has_input.is_set():
+            self.oled.clear()
+            self.oled.text_center_y(0, "history", "#D93BD6", font=self.font_txt)
+            top = 15
+            h = (self.oled.rows - top) // len(graphs)
+            for name, label, color, tier, span in graphs:
+                times, values = self.history.samples(
+                    name, tier, time.time() - span)
+                self.d_sparkline((0, top, self.oled.cols, top + h), label,
+                                 color, values)
+                top += h
+            self.display()
+            self.input_thread.has_input.wait(30)
+
+    def d_sparkline(self, box, label, color, values):
+        """Draw label, last value and the line of values in box
+           (x1 and y1 excluded), scaled to their range"""
+        x0, y0, x1, y1 = box
+        if len(values):
+            label = "%s %.1f" % (label, values[-1])
+        w, h = self.oled.draw_text(x0, y0, label, "#ffffff")
+        if len(values) < 2:
+            return
+        top, bottom = y0 + h + 1, y1 - 2
+        if len(values) > x1 - x0:
+            # one value per column
+            values = values[np.linspace(0, len(values) - 1,
+                                        x1 - x0).astype(int)]
+        low, high = float(values.min()), float(values.max())
+        if high == low:
+            high = low + 1
+        xs = np.linspace(x0, x1 - 1, len(values))
+        ys = bottom - (values - low) / (high - low) * (bottom - top)
+        self.oled.draw.line(zip(xs, ys), fill=color)
+
     def d_brightness(self):
         pass
 
@@ -402,7 +716,7 @@ class Clock(object):
         self.alarm = ""
         self.freeze = 0
 
-    def d_void(self):
+    def d_void(self, *args):
         pass
 
 
@@ -414,76 +728,13 @@ if __name__ == '__main__':
     led = ssd1351.SSD1351(reset_pin=RESET_PIN, dc_pin=DC_PIN, rows=96)
     clk = Clock(led)
 
-    # For buttons, or encoders, check for interrupts (https://pythonhosted.org/RPIO/rpio_py.html)
-    now = datetime.datetime.now()
-
     led.clear()
-    font = ImageFont.truetype("lcd.ttf", 58)
-
     led.log.setLevel(logging.WARNING)
 
-    hours = now.hour
-    minutes = now.minute
-
-    # time sync
-    time.sleep(1-datetime.datetime.now().microsecond/1000.0/1000.0)
-    REFRESH_RATE = 1
-
     # Alarm (fixed for testing purpose)
     clk.alarm = "" # 07:00"
-    big = ImageFont.truetype("wendy.ttf", 70)
     try:
-        while True:
-            now = datetime.datetime.now()
-            resync = 0
-            clk.clear()
-            if clk.input_thread.has_input.is_set():
-                with clk.audio_thread.lock:
-                    wheel = clk.input_thread.wheel
-                    click = clk.input_thread.click
-                if wheel != 0 and not clk.in_menu:
-                    new_vol = clk.audio_thread.volume + clk.input_thread.wheel
-                    clk.d_volume(new_vol)
-                elif click or wheel != 0:
-                    clk.d_menu(click, wheel)
-                with clk.input_thread.lock:
-                    clk.input_thread.wheel = 0
-                    clk.input_thread.click = False
-                clk.input_thread.has_input.clear()
-            # elif clk.freeze > 0:
-            #     clk.freeze -= 1
-            #     clk.d_menu()
-            else:
-                clk.in_menu = False
-                clk.d_clock()
-                clk.d_mplayer()
-            if not clk.in_menu:
-                clk.d_signal()
-                clk.d_temp()
-                clk.d_audio()
-                clk.d_alarm()
-            clk.d_cpu()
-
-            clk.display()
-
-            if minutes != now.minute:
-                # refresh minutes
-                minutes = now.minute
-                if (now.microsecond > 100000):
-                    resync = 0 - (now.microsecond/1000.0/1000.0)
-
-            # end here
-            d = (datetime.datetime.now()-now).total_seconds()
-            s = max(REFRESH_RATE - d + resync, 0)
-            if s > 0:
-                # time.sleep(s)
-                clk.input_thread.has_input.wait(s + 60*self.freeze)
-            if resync:
-                log.info("process: %.4f sleep: %.4f total: %.4f resync: %.2fms"
-                         % (d, s, d+s, resync*1000))
-            elif d > 0.5:
-                log.info("process: %.4f sleep: %.4f total: %.4f overhead!"
-                         % (d, s, d+s))
+        clk.loop()
     except KeyboardInterrupt, e:
         pass  #clk.shutdown()
     except:
@@ -0,0 +1,166 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Layered compositor
+#
+# The screen is split in named layers, from bottom to top. A layer holds
+# widgets: a screen area (bounds), a data source and a painter drawing
+# through SSD1351. Layers are cached in their own RGBA buffer, and a
+# widget is only repainted when its source value changed. Volatile
+# layers are not cached: they are painted straight over the composited
+# frame.
+#
+# Rendering returns the damaged areas, so the display driver can refresh
+# just those.
+# ----------------------------------------------------------------------
+
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+import numpy as np
+
+TRANSPARENT = (0, 0, 0, 0)
+
+
+def intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class Widget(object):
+    """Screen area painted from a data source
+
+       bounds is a (x0, y0, x1, y1) box, x1 and y1 excluded.
+       source() returns the value to show, paint(value) draws it.
+       Without source, the widget is painted once: paint()."""
+
+    def __init__(self, name, bounds, source, paint):
+        self.name = name
+        self.bounds = tuple(bounds)
+        self.source = source
+        self.paint = paint
+        self.value = None
+        self.valid = False
+
+    def poll(self):
+        """Read the source, return True if the value changed"""
+        value = self.source() if self.source is not None else None
+        if self.valid and value == self.value:
+            return False
+        self.value = value
+        self.valid = True
+        return True
+
+    def draw(self):
+        if self.source is None:
+            self.paint()
+        else:
+            self.paint(self.value)
+
+
+class Layer(object):
+    """One cached layer"""
+
+    def __init__(self, name, size, widgets, volatile=False):
+        self.name = name
+        self.size = size
+        self.widgets = list(widgets)
+        self.volatile = volatile
+        self.dirty = True
+        self.renders = 0
+        if not volatile:
+            self.im = Image.new("RGBA", size, TRANSPARENT)
+            self.draw = ImageDraw.Draw(self.im)
+            self.out = self.im.copy()
+
+    def invalidate(self):
+        self.dirty = True
+
+    def damaged(self):
+        """Poll the widgets, return the ones to repaint"""
+        changed = [w for w in self.widgets if w.poll()]
+        if self.dirty or self.volatile:
+            return self.widgets if self.dirty else changed
+        # repainting a widget clears its bounds: the widgets overlapping
+        # them must be repainted too
+        damaged = set(changed)
+        grown = bool(changed)
+        while grown:
+            grown = False
+            for w in self.widgets:
+                if w not in damaged and \
+                   any(intersects(w.bounds, d.bounds) for d in damaged):
+                    damaged.add(w)
+                    grown = True
+        return [w for w in self.widgets if w in damaged]
+
+    def update(self, oled):
+        """Repaint the damaged widgets, return the damaged boxes"""
+        widgets = self.damaged()
+        if self.volatile:
+            for w in self.widgets:
+                w.draw()
+            self.dirty = False
+            return [w.bounds for w in widgets]
+        if not widgets:
+            return []
+        if self.dirty:
+            boxes = [(0, 0) + self.size]
+        else:
+            boxes = [w.bounds for w in widgets]
+        for box in boxes:
+            self.im.paste(TRANSPARENT, box)
+        with oled.target(self.im, self.draw):
+            for w in widgets:
+                w.draw()
+        for box in boxes:
+            self.out.paste(self.unpremultiply(self.im.crop(box)), box[:2])
+        self.dirty = False
+        self.renders += 1
+        return boxes
+
+    @staticmethod
+    def unpremultiply(im):
+        """Antialiased drawing on a transparent layer scales the colours
+           by the coverage, stored in alpha too: divide it back out so
+           the layer composites the same as drawing on the frame"""
+        a = np.array(im)
+        alpha = a[..., 3:4].astype(np.uint16)
+        partial = (alpha > 0) & (alpha < 255)
+        rgb = (a[..., :3].astype(np.uint16) * 255 + alpha // 2) // \
+            np.maximum(alpha, 1)
+        a[..., :3] = np.where(partial, np.minimum(rgb, 255), a[..., :3])
+        return Image.fromarray(a, "RGBA")
+
+
+class Compositor(object):
+    """Render layers into the display buffer"""
+
+    def __init__(self, oled):
+        self.oled = oled
+        self.layers = OrderedDict()
+
+    def add_layer(self, name, widgets, volatile=False):
+        layer = Layer(name, (self.oled.cols, self.oled.rows), widgets,
+                      volatile=volatile)
+        self.layers[name] = layer
+        return layer
+
+    def invalidate(self, *names):
+        """Invalidate the given layers, all of them by default"""
+        for name in names or self.layers.keys():
+            self.layers[name].invalidate()
+
+    def render(self, names=None):
+        """Composite the layers (or only `names`) over the display buffer,
+           return the damaged boxes"""
+        damage = []
+        for layer in self.layers.values():
+            if names is not None and layer.name not in names:
+                continue
+            damage.extend(layer.update(self.oled))
+            if not layer.volatile:
+                self.oled.im.paste(layer.out, (0, 0), layer.out)
+        return damage
+
+    def stats(self):
+        return dict((name, layer.renders)
+                    for name, layer in self.layers.items())
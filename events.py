@@ -0,0 +1,199 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Event bus and main loop scheduler
+#
+# Worker threads publish what changed (player, volume, temperature,
+# input...) and the main loop sleeps until an event arrives or a timed
+# deadline is due.
+#
+# The bus wakes the main loop through a pipe and select(): with python 2
+# a Condition.wait(timeout) polls in small sleeps, waking up the CPU
+# many times per second for nothing.
+#
+# The scheduler deadlines are wall clock times (the colon blinks on the
+# second), waited for on CLOCK_MONOTONIC, and compared to the wall clock
+# after every sleep: a step of the clock (NTP, date) re-anchors them at
+# once instead of leaving the loop asleep for the size of the step.
+# ----------------------------------------------------------------------
+
+import os
+import fcntl
+import select
+import threading
+import time
+from collections import deque
+
+import tools
+
+# topics
+PLAYER = "player"       # (state, title)
+PLAYLIST = "playlist"   # mpd playlist
+VOLUME = "volume"       # mixer volume, %
+TEMP = "temp"           # temperature, °C
+SENSOR = "sensor"       # (1-Wire sensor id, temperature °C)
+CPU = "cpu"             # cpu load, %
+WIFI = "wifi"           # wifi signal, %
+INPUT = "input"         # first input tools.monotonic(), see th.Input
+ALARM = "alarm"         # alarm due
+CLOCK = "clock"         # wall clock step, seconds
+
+# wall clock steps larger than this are jumps, not NTP slewing (seconds)
+JUMP = 0.05
+# longest sleep between two looks at the wall clock (seconds)
+CHECK = 1.0
+# sleeps shorter than this are precise enough in one go (seconds)
+SLACK = 0.005
+
+
+class EventBus(object):
+    """Events published by the worker threads, for the main loop"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.values = {}
+        self.subscribers = {}
+        self.signaled = False
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.published = 0
+        self.wakeups = 0
+
+    def publish(self, topic, value=None):
+        """Record the latest value of topic and wake the main loop"""
+        with self.lock:
+            self.values[topic] = value
+            self.queue.append((topic, value))
+            self.published += 1
+            wake = not self.signaled
+            self.signaled = True
+            callbacks = list(self.subscribers.get(topic, ()))
+        if wake:
+            try:
+                os.write(self.wfd, "!")
+            except OSError:
+                pass
+        for callback in callbacks:
+            callback(topic, value)
+
+    def subscribe(self, topic, callback):
+        """Call callback(topic, value) from the publishing thread"""
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+
+    def latest(self, topic, default=None):
+        return self.values.get(topic, default)
+
+    def fileno(self):
+        return self.rfd
+
+    def wait(self, timeout=None):
+        """Wait for events (timeout in seconds, None for ever),
+           return the list of (topic, value) published since last call"""
+        with self.lock:
+            pending = bool(self.queue)
+        if not pending:
+            try:
+                select.select([self.rfd], [], [], timeout)
+            except select.error:
+                pass
+        return self.drain()
+
+    def drain(self):
+        with self.lock:
+            events = list(self.queue)
+            self.queue.clear()
+            self.signaled = False
+            try:
+                os.read(self.rfd, 64)
+            except OSError:
+                pass
+            if events:
+                self.wakeups += 1
+        return events
+
+    def stats(self):
+        with self.lock:
+            return {"published": self.published, "wakeups": self.wakeups}
+
+
+class Scheduler(object):
+    """Timed deadlines on top of the event bus
+
+       Due deadlines are returned by wait() as (name, when) events, a
+       wall clock step as a (CLOCK, step) event. The lateness of the
+       deadlines is observed by the `jitter` histogram, if any."""
+
+    def __init__(self, bus, jitter=None):
+        self.bus = bus
+        self.jitter = jitter
+        self.timers = {}
+        # time.time() - tools.monotonic()
+        self.offset = time.time() - tools.monotonic()
+        self.fired = 0
+        self.late_sum = 0.0
+        self.late_max = 0.0
+        self.jumps = 0
+
+    def at(self, name, when):
+        """Set (or move) deadline `name` to time.time() `when`"""
+        self.timers[name] = when
+
+    def cancel(self, name):
+        self.timers.pop(name, None)
+
+    def sync(self):
+        """Follow the wall clock, return its step if it jumped, else 0"""
+        offset = time.time() - tools.monotonic()
+        step = offset - self.offset
+        self.offset = offset
+        if abs(step) < JUMP:
+            return 0
+        self.jumps += 1
+        return step
+
+    def wait(self):
+        while True:
+            timeout = CHECK
+            if self.timers:
+                deadline = min(self.timers.values()) - self.offset
+                timeout = min(max(deadline - tools.monotonic(), 0), CHECK)
+                # the kernel lets select() oversleep by 0.1% of the
+                # timeout: wake up early, then sleep for what is left
+                if timeout > SLACK:
+                    timeout -= timeout / 500
+            events = self.bus.wait(timeout)
+            step = self.sync()
+            if step:
+                events.append((CLOCK, step))
+            now = tools.monotonic()
+            for name, when in sorted(self.timers.items(), key=lambda t: t[1]):
+                late = now - (when - self.offset)
+                if late < 0:
+                    continue
+                del self.timers[name]
+                events.append((name, when))
+                # deadlines skipped over by a step are not late
+                if not step:
+                    self.observe(late)
+            if events:
+                return events
+
+    def observe(self, late):
+        self.fired += 1
+        self.late_sum += late
+        self.late_max = max(self.late_max, late)
+        if self.jitter is not None:
+            self.jitter.observe(late)
+
+    def stats(self):
+        mean = self.late_sum / self.fired if self.fired else 0
+        return {"fired": self.fired, "jumps": self.jumps,
+                "late_mean_ms": round(mean * 1000, 3),
+                "late_max_ms": round(self.late_max * 1000, 3)}
+
+
+bus = EventBus()
@@ -0,0 +1,76 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Process wide font registry
+#
+# Loading a TrueType font reads and parses the whole file from the SD
+# card, so fonts are loaded once and shared, keyed by (path, size).
+# ----------------------------------------------------------------------
+
+import threading
+import logging
+from collections import OrderedDict
+from PIL import ImageFont
+
+DROID_MONO = "/usr/share/fonts/truetype/droid/DroidSansMono.ttf"
+DROID_FALLBACK = "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf"
+# used when a font is not installed (the Droid fonts only ship with Raspbian)
+FALLBACK = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+log = logging.getLogger(__name__)
+
+
+class FontRegistry(object):
+    """LRU cache of loaded fonts"""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.fonts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # paths already replaced by FALLBACK
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def get(self, path, size):
+        """Return the font at `path` with `size`, loading it if needed"""
+        key = (path, size)
+        with self.lock:
+            font = self.fonts.pop(key, None)
+            if font is not None:
+                self.hits += 1
+                self.fonts[key] = font
+                return font
+            self.misses += 1
+
+        log.debug("loading font %s (%s)" % (path, size))
+        try:
+            font = ImageFont.truetype(path, size)
+        except IOError:
+            if path == FALLBACK:
+                raise
+            with self.lock:
+                first = path not in self.missing
+                self.missing.add(path)
+            if first:
+                log.warning("font %s not found, using %s" % (path, FALLBACK))
+            else:
+                log.debug("font %s not found, using %s" % (path, FALLBACK))
+            font = ImageFont.truetype(FALLBACK, size)
+        with self.lock:
+            self.fonts[key] = font
+            while len(self.fonts) > self.maxsize:
+                self.fonts.popitem(last=False)
+        return font
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.fonts), "maxsize": self.maxsize}
+
+
+registry = FontRegistry()
+
+
+def get(path, size):
+    return registry.get(path, size)
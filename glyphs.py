@@ -0,0 +1,146 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Glyph atlas
+#
+# Text drawn every second with a few fixed fonts (clock digits, date,
+# temperature...) is built by pasting glyphs rasterised once, instead of
+# running FreeType on every frame.
+# ----------------------------------------------------------------------
+
+import threading
+from PIL import Image, ImageChops, ImageDraw
+
+DIGITS = u"0123456789"
+
+
+class GlyphAtlas(object):
+    """Pre-rasterised glyphs of one font
+
+       Glyphs are keyed by character, coloured tiles by
+       (character, colour, mode), and the pen offset between two
+       characters (advance and kerning) by pair."""
+    # room around a glyph while it is rasterised
+    PAD = 8
+
+    def __init__(self, font, charset=u""):
+        self.font = font
+        self.glyphs = {}
+        self.tiles = {}
+        self.offsets = {}
+        for a in charset:
+            self.glyph(a)
+            for b in charset:
+                self.offset(a, b)
+
+    def glyph(self, char):
+        """(mask, (x, y), size) of `char`: its bitmap, None for a blank
+           glyph, where it goes from the pen position, and the box
+           font.getsize() gives it"""
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            # the box FreeType gives a lone glyph comes from its rounded
+            # outline, and can cut a row of the hinted bitmap: rasterise
+            # it with room to spare, keep the ink, and put its top where
+            # the font says the glyph starts
+            images = []
+
+            def fill(mode, size, color=0):
+                im = Image.new("L", (size[0] + self.PAD, size[1] + self.PAD),
+                               color)
+                images.append(im)
+                return im.im
+            self.font.getmask2(char, "L", fill=fill)
+            x, y = self.font.getoffset(char)
+            box = images[0].getbbox()
+            mask = None
+            if box is not None:
+                mask = images[0].crop(box)
+                x += box[0]
+            glyph = (mask, (x, y), self.font.getsize(char))
+            self.glyphs[char] = glyph
+        return glyph
+
+    def tile(self, char, color, mode="RGB"):
+        key = (char, color, mode)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = Image.new(mode, self.glyph(char)[0].size, color)
+            self.tiles[key] = tile
+        return tile
+
+    def offset(self, a, b):
+        """Distance from the pen position of `a` to the one of `b`"""
+        offset = self.offsets.get((a, b))
+        if offset is None:
+            offset = (self.font.getsize(a + b)[0] -
+                      self.font.getsize(b)[0])
+            self.offsets[(a, b)] = offset
+        return offset
+
+    def textsize(self, text):
+        """Size of `text`, as font.getsize() gives it"""
+        if not text:
+            return 0, 0
+        x = 0
+        h = 0
+        prev = None
+        for char in text:
+            if prev is not None:
+                x += self.offset(prev, char)
+            mask, (dx, dy), (w, ch) = self.glyph(char)
+            h = max(h, ch)
+            if mask is not None:
+                h = max(h, dy + mask.size[1])
+            prev = char
+        return x + w, h
+
+    def draw(self, im, xy, text, color):
+        """Paste `text` at `xy` on image `im`, return the text size"""
+        x, y = xy
+        x0 = x
+        h = 0
+        w = 0
+        prev = None
+        for char in text:
+            if prev is not None:
+                x += self.offset(prev, char)
+            mask, (dx, dy), (w, ch) = self.glyph(char)
+            h = max(h, ch)
+            if mask is not None:
+                h = max(h, dy + mask.size[1])
+                im.paste(self.tile(char, color, im.mode),
+                         (int(x + dx), int(y + dy)), mask)
+            prev = char
+        return x + w - x0, h
+
+
+_atlases = {}
+_lock = threading.Lock()
+
+
+def atlas(font, charset=u""):
+    """Return the shared atlas of `font`
+
+       Atlases are keyed by the font file and size, like the fonts
+       registry: a font evicted and loaded again gets the same atlas."""
+    key = (font.path, font.size)
+    with _lock:
+        a = _atlases.get(key)
+        if a is None:
+            a = GlyphAtlas(font, charset)
+            _atlases[key] = a
+        return a
+
+
+def check(a, text):
+    """Number of pixels where `text` drawn from atlas `a` differs from
+       ImageDraw.text with its font"""
+    w, h = a.font.getsize(text)
+    size = (w + 2*a.PAD, h + 2*a.PAD)
+    xy = (a.PAD, a.PAD)
+    ref = Image.new("L", size)
+    ImageDraw.Draw(ref).text(xy, text, font=a.font, fill=255)
+    im = Image.new("L", size)
+    a.draw(im, xy, text, 255)
+    return sum(1 for v in ImageChops.difference(ref, im).getdata() if v)
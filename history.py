@@ -0,0 +1,240 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Sensor history
+#
+# Every series (cpu load, wifi signal, each temperature sensor) is kept
+# in fixed size rings of numpy arrays, one per tier: the raw samples, and
+# their averages per minute and per quarter of an hour. The memory used
+# never grows, and there is no object per sample.
+#
+# The store is written to a binary file (PIOCLOCK_HISTORY, default
+# /var/lib/pioclock/history.bin, empty to keep it in memory only) every
+# FLUSH seconds and on shutdown, so the history survives a restart with
+# a few writes per hour on the SD card.
+# ----------------------------------------------------------------------
+
+import os
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import events
+
+PATH = os.environ.get("PIOCLOCK_HISTORY", "/var/lib/pioclock/history.bin")
+# seconds between two writes of the file
+FLUSH = 30*60
+
+# (seconds averaged, 0 for the raw samples, samples kept)
+TIERS = ((0, 360), (60, 24*60), (15*60, 7*24*4))
+RAW, MINUTE, QUARTER = range(3)
+
+MAGIC = "PIOH"
+VERSION = 1
+HEADER = struct.Struct("<4sBH")
+TIER = struct.Struct("<IIIIIdI")
+
+log = logging.getLogger(__name__)
+
+
+class Tier(object):
+    """Ring of the last `size` (time, value) samples, each one the
+       average over `step` seconds (0 keeps every sample)"""
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.times = np.zeros(size, np.uint32)
+        self.values = np.zeros(size, np.float32)
+        # next slot, and slots used
+        self.head = 0
+        self.count = 0
+        # step being averaged, sum and number of its samples
+        self.bucket = 0
+        self.sum = 0.0
+        self.n = 0
+
+    def add(self, when, value):
+        if not self.step:
+            self.push(when, value)
+            return
+        bucket = int(when // self.step)
+        if bucket != self.bucket:
+            if self.n:
+                self.push(self.bucket * self.step, self.sum / self.n)
+            self.bucket = bucket
+            self.sum = 0.0
+            self.n = 0
+        self.sum += value
+        self.n += 1
+
+    def push(self, when, value):
+        self.times[self.head] = when
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self, since=0):
+        """(times, values) arrays of the samples from `since`,
+           oldest first"""
+        if self.count < self.size:
+            times = self.times[:self.count]
+            values = self.values[:self.count]
+        else:
+            times = np.roll(self.times, -self.head)
+            values = np.roll(self.values, -self.head)
+        keep = times >= since
+        return times[keep], values[keep]
+
+    def pack(self):
+        return TIER.pack(self.step, self.size, self.head, self.count,
+                         self.bucket, self.sum, self.n) + \
+            self.times.tostring() + self.values.tostring()
+
+    def unpack(self, data, offset):
+        """Restore the tier saved at data[offset:], return the offset
+           after it"""
+        step, size, head, count, bucket, total, n = \
+            TIER.unpack_from(data, offset)
+        offset += TIER.size
+        if (step, size) != (self.step, self.size):
+            raise ValueError("tier (%d, %d) saved as (%d, %d)"
+                             % (self.step, self.size, step, size))
+        self.times = np.frombuffer(data, np.uint32, size, offset).copy()
+        offset += self.times.nbytes
+        self.values = np.frombuffer(data, np.float32, size, offset).copy()
+        offset += self.values.nbytes
+        self.head, self.count = head, count
+        self.bucket, self.sum, self.n = bucket, total, n
+        return offset
+
+
+class Store(object):
+    """Series of samples by name, in TIERS"""
+
+    def __init__(self, tiers=TIERS):
+        self.tiers = tiers
+        self.series = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def add(self, name, value, when=None):
+        if when is None:
+            when = time.time()
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                series = [Tier(step, size) for step, size in self.tiers]
+                self.series[name] = series
+            for tier in series:
+                tier.add(when, value)
+            self.dirty = True
+
+    def samples(self, name, tier=RAW, since=0):
+        """(times, values) of series `name` in `tier`, from `since`"""
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                return np.zeros(0, np.uint32), np.zeros(0, np.float32)
+            return series[tier].samples(since)
+
+    def subscribe(self, bus=events.bus):
+        """Record the cpu load, wifi signal and temperatures published"""
+        bus.subscribe(events.CPU, lambda topic, cpu: self.add("cpu", cpu))
+        bus.subscribe(events.WIFI, lambda topic, wifi: self.add("wifi", wifi))
+        bus.subscribe(events.SENSOR,
+                      lambda topic, value: self.add("temp/%s" % value[0],
+                                                    value[1]))
+
+    def save(self, path):
+        """Write the store to `path`, atomically, even across a power
+           cut"""
+        with self.lock:
+            parts = [HEADER.pack(MAGIC, VERSION, len(self.series))]
+            for name, series in self.series.items():
+                parts.append(struct.pack("<B", len(name)) + name)
+                for tier in series:
+                    parts.append(tier.pack())
+            self.dirty = False
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = "%s.%d" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write("".join(parts))
+                # on disk before the rename, or it may replace the old
+                # file with an empty one
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # try again on the next flush
+            self.dirty = True
+            raise
+
+    def load(self, path):
+        """Read back the series saved in `path`, if any"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return
+        try:
+            magic, version, count = HEADER.unpack_from(data)
+            if (magic, version) != (MAGIC, VERSION):
+                raise ValueError("not a version %d history" % VERSION)
+            offset = HEADER.size
+            series = OrderedDict()
+            for i in range(count):
+                n = ord(data[offset])
+                name = data[offset+1:offset+1+n]
+                offset += 1 + n
+                tiers = [Tier(step, size) for step, size in self.tiers]
+                for tier in tiers:
+                    offset = tier.unpack(data, offset)
+                series[name] = tiers
+        except (struct.error, ValueError, IndexError), e:
+            log.warning("cannot read history %s: %s" % (path, e))
+            return
+        with self.lock:
+            self.series.update(series)
+
+
+class Writer(threading.Thread):
+    """Save the store to `path` every `interval` seconds, when it
+       changed"""
+
+    def __init__(self, store, path=PATH, interval=FLUSH):
+        super(Writer, self).__init__()
+        self.daemon = True
+        self.store = store
+        self.path = path
+        self.interval = interval
+        self.must_stop = threading.Event()
+        self.failed = False
+
+    def save(self):
+        if not self.store.dirty:
+            return
+        try:
+            self.store.save(self.path)
+            self.failed = False
+        except (IOError, OSError), e:
+            # only warn once per failure streak
+            if not self.failed:
+                log.warning("cannot write history to %s: %s" % (self.path, e))
+            self.failed = True
+
+    def run(self):
+        # a plain sleep: Event.wait(timeout) polls with python 2
+        while not self.must_stop.is_set():
+            time.sleep(self.interval)
+            self.save()
+
+    def stop(self):
+        self.must_stop.set()
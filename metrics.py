@@ -0,0 +1,167 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Metrics
+#
+# Counters and fixed bucket histograms, cheap enough to be updated on
+# every frame, periodically written in the Prometheus textfile format
+# (for the node_exporter textfile collector) so frame costs can be
+# trended over weeks.
+#
+# The file is set with the PIOCLOCK_METRICS environment variable
+# (default: /var/lib/node_exporter/textfile_collector/pioclock.prom),
+# an empty value disables the export.
+# ----------------------------------------------------------------------
+
+import os
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+PATH = os.environ.get("PIOCLOCK_METRICS",
+                      "/var/lib/node_exporter/textfile_collector/"
+                      "pioclock.prom")
+
+# seconds, from a fast partial refresh to a stalled frame
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5)
+
+log = logging.getLogger(__name__)
+
+
+class Counter(object):
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.doc),
+                "# TYPE %s counter" % self.name,
+                "%s %s" % (self.name, self.value)]
+
+
+class Histogram(object):
+    """Observations counted in fixed buckets (upper bounds, inclusive)"""
+
+    def __init__(self, name, doc, buckets=TIME_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        # last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block"""
+        return Timer(self)
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s histogram" % self.name]
+        n = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            n += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, n))
+        lines.append("%s_sum %r" % (self.name, total))
+        lines.append("%s_count %d" % (self.name, n))
+        return lines
+
+
+class Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, cls, name, *args):
+        """Return metric `name`, created if needed"""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args)
+                self.metrics[name] = metric
+            return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to `path`, atomically for the collector"""
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+
+registry = Registry()
+
+
+def counter(name, doc):
+    return registry.add(Counter, name, doc)
+
+
+def histogram(name, doc, buckets=TIME_BUCKETS):
+    return registry.add(Histogram, name, doc, buckets)
+
+
+class Exporter(threading.Thread):
+    """Write the registry to `path` every `interval` seconds"""
+
+    def __init__(self, path=PATH, interval=60):
+        super(Exporter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.must_stop = threading.Event()
+        self.failed = False
+
+    def export(self):
+        try:
+            registry.write(self.path)
+            self.failed = False
+        except (IOError, OSError), e:
+            # only warn once per failure streak
+            if not self.failed:
+                log.warning("cannot write metrics to %s: %s" % (self.path, e))
+            self.failed = True
+
+    def run(self):
+        # a plain sleep: Event.wait(timeout) polls with python 2
+        while not self.must_stop.is_set():
+            time.sleep(self.interval)
+            self.export()
+
+    def stop(self):
+        self.must_stop.set()
@@ -10,6 +10,11 @@ import ssd1351
 import datetime
 import time
 import signal
+import fonts
+import metrics
+import tracing
+import reactor
+import history
 from clock import Clock
 from textwrap import wrap
 
@@ -33,6 +38,22 @@ class piOClock(daemon.Daemon):
 
     def shutdown(self, signum=0, frame=None):
         self.log.info("Shutdown clock...")
+        self.log.info("font cache: %s" % (fonts.registry.stats(),))
+        self.log.info("scheduler: %s" % (self.clk.sched.stats(),))
+        self.log.info("reactor: %s" % (reactor.reactor.stats(),))
+        if self.clk.oled.sender is not None:
+            self.log.info("transfer: %s" % (self.clk.oled.sender.stats(),))
+        if hasattr(self.clk, "mpd_thread"):
+            self.log.info("mpd commands: %s" % (self.clk.mpd_thread.mpc.stats(),))
+        if hasattr(self.clk, "temp_node"):
+            self.log.info("temperature: %s" % (self.clk.temp_node.stats(),))
+        if hasattr(self.clk, "input_thread"):
+            self.log.info("input: %s" % (self.clk.input_thread.stats(),))
+        if self.exporter is not None:
+            self.exporter.export()
+        if self.history_writer is not None:
+            self.history_writer.save()
+        self.clk.oled.stop_scroll()
         self.clk.clear()
         self.clk.oled.text_center("Exiting...", "blue", size=30)
         self.clk.display()
@@ -47,79 +68,30 @@ class piOClock(daemon.Daemon):
         DC_PIN = 16
         led = ssd1351.SSD1351(reset_pin=RESET_PIN, dc_pin=DC_PIN, rows=96)
         self.clk = Clock(led)
+        # render the next frame while the previous one is sent
+        led.start_transfer()
+        self.exporter = None
+        if metrics.PATH:
+            self.exporter = metrics.Exporter(metrics.PATH)
+            self.exporter.start()
+        self.history_writer = None
+        if history.PATH:
+            self.history_writer = history.Writer(self.clk.history)
+            self.history_writer.start()
 
         # handle sigterm
         signal.signal(signal.SIGTERM, self.shutdown)
-
-        now = datetime.datetime.now()
+        # dump the last spans on sigusr1
+        tracing.tracer.install(signal.SIGUSR1)
 
         led.clear()
 
         led.log.setLevel(logging.WARNING)
 
-        hours = now.hour
-        minutes = now.minute
-
-        # time sync
-        time.sleep(1-datetime.datetime.now().microsecond/1000.0/1000.0)
-        REFRESH_RATE = 1
-
         # Alarm (fixed for testing purpose)
         self.clk.alarm = ""  # 07:00"
         try:
-            while True:
-                now = datetime.datetime.now()
-                resync = 0
-                self.clk.clear()
-                if self.clk.input_thread.has_input.is_set():
-                    with self.clk.audio_thread.lock:
-                        wheel = self.clk.input_thread.wheel
-                        click = self.clk.input_thread.click
-                    self.clk.input_thread.has_input.clear()
-                    if wheel != 0 and not self.clk.in_menu:
-                        new_vol = self.clk.audio_thread.volume + self.clk.input_thread.wheel
-                        self.clk.d_volume(new_vol)
-                    elif click or wheel != 0:
-                        self.clk.d_menu(click, wheel)
-                    with self.clk.input_thread.lock:
-                        self.clk.input_thread.wheel = 0
-                        self.clk.input_thread.click = False
-                # elif clk.freeze > 0:
-                #    clk.freeze -= 1
-                #    clk.d_menu()
-                else:
-                    self.clk.in_menu = False
-                    self.clk.in_volume = False
-                    self.clk.freeze = 0
-                self.clk.d_clock()
-                if not self.clk.in_menu:
-                    self.clk.d_mplayer()
-                    self.clk.d_signal()
-                    self.clk.d_temp()
-                    self.clk.d_audio()
-                    self.clk.d_alarm()
-                self.clk.d_cpu()
-
-                self.clk.display()
-
-                if minutes != now.minute:
-                    # refresh minutes
-                    minutes = now.minute
-                    if (now.microsecond > 100000):
-                        resync = 0 - (now.microsecond/1000.0/1000.0)
-
-                # end here
-                d = (datetime.datetime.now()-now).total_seconds()
-                s = max(REFRESH_RATE - d + resync, 0)
-                if s > 0:
-                    # time.sleep(s)
-                    self.clk.input_thread.has_input.wait(s + 1*self.clk.freeze)
-                if resync:
-                    self.log.info("process: %.4f sleep: %.4f total: %.4f resync: %.2fms"
-                                  % (d, s, d+s, resync*1000))
-                elif d > 0.5:
-                    self.log.info("process: %.4f sleep: %.4f total: %.4f overhead!"
-                                  % (d, s, d+s))
+            self.clk.loop()
         except KeyboardInterrupt, e:
             self.shutdown()
         except Exception, e:
@@ -0,0 +1,135 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# I/O reactor
+#
+# The mixer, the mpd idle connection and the GPIO edges are file
+# descriptors idle most of the time: a single thread waits on all of them
+# with epoll and calls their handler, instead of one sleeping thread
+# each. Handlers run on the reactor thread and must not block (slow work
+# goes to a worker, like th.MPlayerControl).
+# ----------------------------------------------------------------------
+
+import os
+import fcntl
+import heapq
+import itertools
+import logging
+import select
+import threading
+
+import tools
+
+
+class Reactor(threading.Thread):
+    """epoll loop calling callback(fd, mask) when a registered fd is
+       ready, started with the first registration"""
+
+    def __init__(self):
+        super(Reactor, self).__init__(name="Reactor")
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.daemon = True
+        self.must_stop = threading.Event()
+        self.lock = threading.Lock()
+        self.epoll = select.epoll()
+        self.handlers = {}
+        # (tools.monotonic() deadline, sequence, callback)
+        self.timers = []
+        self.sequence = itertools.count()
+        self.running = False
+        # wakes the loop up for new timers and stop()
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.epoll.register(self.rfd, select.EPOLLIN)
+        self.dispatched = 0
+        self.errors = 0
+
+    def register(self, fd, mask, callback):
+        with self.lock:
+            self.handlers[fd] = callback
+            self.epoll.register(fd, mask)
+            if not self.running:
+                self.running = True
+                self.start()
+
+    def modify(self, fd, mask):
+        self.epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        with self.lock:
+            if self.handlers.pop(fd, None) is None:
+                return
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                # already closed
+                pass
+
+    def call_later(self, delay, callback):
+        """Call callback() on the reactor thread in delay seconds"""
+        with self.lock:
+            heapq.heappush(self.timers, (tools.monotonic() + delay,
+                                         next(self.sequence), callback))
+            if not self.running:
+                self.running = True
+                self.start()
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wfd, "!")
+        except OSError:
+            pass
+
+    def run(self):
+        self.log.debug("%s thread started" % self.name)
+        while not self.must_stop.is_set():
+            timeout = -1
+            with self.lock:
+                if self.timers:
+                    timeout = max(self.timers[0][0] - tools.monotonic(), 0)
+            try:
+                ready = self.epoll.poll(timeout)
+            except IOError:
+                # EINTR
+                continue
+            for fd, mask in ready:
+                if fd == self.rfd:
+                    try:
+                        os.read(self.rfd, 64)
+                    except OSError:
+                        pass
+                    continue
+                callback = self.handlers.get(fd)
+                if callback is not None:
+                    self.dispatch(callback, fd, mask)
+            now = tools.monotonic()
+            while True:
+                with self.lock:
+                    if not self.timers or self.timers[0][0] > now:
+                        break
+                    callback = heapq.heappop(self.timers)[2]
+                self.dispatch(callback)
+
+    def dispatch(self, callback, *args):
+        self.dispatched += 1
+        try:
+            callback(*args)
+        except Exception, e:
+            # one broken handler must not stop the others
+            self.errors += 1
+            self.log.exception(e)
+
+    def stop(self):
+        self.log.debug("%s request stop" % self.name)
+        self.must_stop.set()
+        self.wake()
+
+    def stats(self):
+        return {"fds": len(self.handlers), "dispatched": self.dispatched,
+                "errors": self.errors}
+
+
+reactor = Reactor()
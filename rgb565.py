@@ -0,0 +1,123 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# RGB888 to RGB565 convertion for the SSD1351 RAM
+#
+# The display expects 2 bytes per pixel, most significant byte first:
+# 15 14 13 12 11 10 9 8 7 6 5 4 3 2 1 0
+#  r  r  r  r  r  g g g g g g b b b b b
+#
+# Conversion modes:
+#   shift  : drop the low bits of every channel (truncates)
+#   lut    : 256 entries lookup tables per channel, rounded to the
+#            nearest level
+#   dither : 4x4 ordered dithering through lookup tables, for gradients.
+#            The pattern is anchored to the screen, so partial updates
+#            line up with the rest of the frame.
+# ----------------------------------------------------------------------
+
+import numpy as np
+
+MODES = ("shift", "lut", "dither")
+
+# 4x4 Bayer matrix
+BAYER4 = np.array([[0, 8, 2, 10],
+                   [12, 4, 14, 6],
+                   [3, 11, 1, 9],
+                   [15, 7, 13, 5]])
+
+
+def levels(bits, threshold):
+    """Level of every 8 bits value on `bits` bits, rounding up from
+       `threshold` (0.5 rounds to the nearest)"""
+    top = (1 << bits) - 1
+    v = np.arange(256) * top / 255.0 + threshold
+    return np.minimum(v.astype(int), top)
+
+
+def tables(r5, g6, b5):
+    """Lookup tables giving each channel part of the high and low bytes"""
+    return (((r5 << 3) & 0xF8).astype(np.uint8),    # rrrrr...
+            (g6 >> 3).astype(np.uint8),             # .....ggg
+            ((g6 << 5) & 0xE0).astype(np.uint8),    # ggg.....
+            b5.astype(np.uint8))                    # ...bbbbb
+
+
+class Converter(object):
+    """Convert RGB888 frames to RGB565 in a preallocated buffer
+
+       The same buffer is reused by every call: the returned view is only
+       valid until the next convert()."""
+
+    def __init__(self, cols, rows, mode="lut"):
+        self.mode = mode
+        self.wire = np.empty(cols * rows * 2, np.uint8)
+        self.tmp = np.empty(cols * rows, np.uint8)
+        self.index = np.empty(cols * rows, np.uint16)
+        self.view = memoryview(self.wire)
+        self.lut = tables(levels(5, 0.5), levels(6, 0.5), levels(5, 0.5))
+        # one table per dither threshold, back to back: the index of a
+        # pixel is value + 256 * threshold
+        thresholds = [(k + 0.5) / 16 for k in range(16)]
+        self.dither_lut = tables(
+            np.concatenate([levels(5, t) for t in thresholds]),
+            np.concatenate([levels(6, t) for t in thresholds]),
+            np.concatenate([levels(5, t) for t in thresholds]))
+        self.bayer = (np.tile(BAYER4, (rows // 4 + 1, cols // 4 + 1))
+                      [:rows, :cols] * 256).astype(np.uint16)
+
+    def convert(self, frame, origin=(0, 0), mode=None):
+        """Convert a (rows, cols, 3) uint8 array, its top left corner
+           being at `origin` on screen, return a memoryview on the wire
+           bytes"""
+        mode = mode or self.mode
+        h, w = frame.shape[:2]
+        n = w * h
+        out = self.wire[:n*2].reshape(h, w, 2)
+        if mode == "shift":
+            self.shift(frame, out)
+        elif mode == "lut":
+            self.lookup(frame, out, self.lut)
+        elif mode == "dither":
+            x, y = origin
+            self.lookup(frame, out, self.dither_lut,
+                        self.bayer[y:y+h, x:x+w])
+        else:
+            raise ValueError("unknown conversion mode %r" % (mode,))
+        return self.view[:n*2]
+
+    def shift(self, frame, out):
+        h, w = frame.shape[:2]
+        tmp = self.tmp[:w*h].reshape(h, w)
+        hi = out[..., 0]
+        lo = out[..., 1]
+        # rrrrrggg
+        np.bitwise_and(frame[..., 0], 0xF8, out=hi)
+        np.right_shift(frame[..., 1], 5, out=tmp)
+        np.bitwise_or(hi, tmp, out=hi)
+        # gggbbbbb
+        np.left_shift(frame[..., 1], 3, out=lo)
+        np.bitwise_and(lo, 0xE0, out=lo)
+        np.right_shift(frame[..., 2], 3, out=tmp)
+        np.bitwise_or(lo, tmp, out=lo)
+
+    def lookup(self, frame, out, luts, offset=None):
+        h, w = frame.shape[:2]
+        tmp = self.tmp[:w*h].reshape(h, w)
+        index = self.index[:w*h].reshape(h, w)
+        r_hi, g_hi, g_lo, b_lo = luts
+        hi = out[..., 0]
+        lo = out[..., 1]
+
+        def at(channel):
+            if offset is None:
+                return frame[..., channel]
+            return np.add(frame[..., channel], offset, out=index)
+
+        np.take(r_hi, at(0), out=hi, mode="clip")
+        g = at(1)
+        np.take(g_hi, g, out=tmp, mode="clip")
+        np.bitwise_or(hi, tmp, out=hi)
+        np.take(g_lo, g, out=lo, mode="clip")
+        np.take(b_lo, at(2), out=tmp, mode="clip")
+        np.bitwise_or(lo, tmp, out=lo)
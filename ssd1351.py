@@ -16,20 +16,42 @@
 # It has the following dependencies:
 # wiringpi2 for GPIO
 # spidev for SPI
+# (or the simulated bus from backends.py, off the Pi)
 # PIL for easy drawing capabilities
-# numpy for fast RGB888 to RGB565 convertion
+# numpy for fast RGB888 to RGB565 convertion (see rgb565.py)
 # ----------------------------------------------------------------------
 
 # NEED HEAVY CLEANING !
 
-import wiringpi2
-import spidev
 import time
 import sys
 from PIL import Image, ImageDraw, ImageFont
 import logging
+import contextlib
+import threading
 import numpy as np
-import tools
+import tracing
+import rgb565
+import fonts
+import glyphs
+import backends
+import canvas
+import metrics
+
+FRAMES = metrics.counter(
+    "pioclock_frames_total", "Frames sent to the display")
+FRAMES_DROPPED = metrics.counter(
+    "pioclock_frames_dropped_total",
+    "Frames replaced by a newer one before being sent")
+FRAME_OVERRUNS = metrics.counter(
+    "pioclock_frame_overruns_total",
+    "Frames submitted while the previous one was being sent")
+PIXEL_BYTES = metrics.counter(
+    "pioclock_spi_pixel_bytes_total", "Pixel bytes written to the display")
+CONVERT_TIME = metrics.histogram(
+    "pioclock_convert_seconds", "RGB565 conversion time per frame")
+SPI_TIME = metrics.histogram(
+    "pioclock_spi_seconds", "SPI transfer time per frame")
 
 
 class SSD1351:
@@ -73,64 +95,119 @@ class SSD1351:
     CMD_STOPSCROLL        = 0x9E
     CMD_STARTSCROLL       = 0x9F
 
+    # partial refresh: changed areas closer than MERGE_GAP pixels are
+    # sent as one window, and no more than MAX_WINDOWS windows per frame
+    MERGE_GAP = 8
+    MAX_WINDOWS = 4
+
+    # solid fills are sent from a buffer holding FILL_CHUNK pixels of
+    # the colour, built once per colour (4096 bytes, the spidev limit)
+    FILL_CHUNK = 2048
+    FILL_PATTERNS = 16
+
+    # horizontal scroll speed, frames between two steps
+    SCROLL_TEST           = 0x00
+    SCROLL_NORMAL         = 0x01
+    SCROLL_SLOW           = 0x02
+    SCROLL_SLOWEST        = 0x03
+
     # Device name will be /dev/spidev-{bus}.{device}
     # dc_pin is the data/commmand pin.  This line is HIGH for data, LOW for command.
     # We will keep d/c low and bump it high only for commands with data
     # reset is normally HIGH, and pulled LOW to reset the display
+    # backend is "hw" or "sim", see backends.py
+    # native draws in a canvas.Canvas, already in the RAM format, instead
+    # of a PIL RGB image: self.draw is then None, draw through self.im
+    # (clock.Clock draws with PIL and refuses a native display)
 
-    def __init__(self, bus=0, device=0, dc_pin="P9_15", reset_pin="P9_13", rows=128, cols=128):
+    def __init__(self, bus=0, device=0, dc_pin="P9_15", reset_pin="P9_13", rows=128, cols=128,
+                 backend=None, native=False):
         self.cols = cols
         self.rows = rows
         self.dc_pin = dc_pin
         self.reset_pin = reset_pin
+        self.spi, self.gpio = backends.open_display(bus, device, dc_pin, backend)
         # SPI
-        self.spi = spidev.SpiDev(bus, device)
         self.spi.max_speed_hz = 16000000    # 16Mhz
+        self.writebuf = getattr(self.spi, "writebytes2", None)
         # GPIO
-        self.gpio = wiringpi2.GPIO(wiringpi2.GPIO.WPI_MODE_PINS)
         self.gpio.pinMode(self.reset_pin, self.gpio.OUTPUT)
         self.gpio.digitalWrite(self.reset_pin, self.gpio.HIGH)
         self.gpio.pinMode(self.dc_pin, self.gpio.OUTPUT)
         self.gpio.digitalWrite(self.dc_pin, self.gpio.LOW)
         # Drawing tools
-        self.im = Image.new("RGB", (cols, rows), 'black')
-        self.draw = ImageDraw.Draw(self.im)
+        self.native = native
+        if native:
+            self.im = canvas.Canvas(cols, rows)
+            self.draw = None
+        else:
+            self.im = Image.new("RGB", (cols, rows), 'black')
+            self.draw = ImageDraw.Draw(self.im)
+        # last frame sent to the GRAM, for partial refresh
+        self.last_frame = None
+        # frames handed to send(), filled in turn: the next frame is
+        # copied in one while the Transfer thread sends the other one
+        self.buffers = [None, None]
+        self.back = 0
+        # held for every SPI transaction, frames may be sent by a
+        # Transfer thread while the main thread sends commands
+        self.bus = threading.RLock()
+        self.sender = None
+        # hardware scrolling: band scrolled by the panel, and band
+        # requested, applied by the next send()
+        self.scroll = None
+        self.scroll_want = None
+        self.converter = rgb565.Converter(cols, rows)
+        self.patterns = {}
         # logging
         self.log = logging.getLogger(self.__class__.__name__)
         self.log.setLevel(logging.INFO)
         self.contrast = 15
 
     def reset(self):
-        self.gpio.digitalWrite(self.reset_pin, self.gpio.LOW)
-        time.sleep(0.010) # 10ms
-        self.gpio.digitalWrite(self.reset_pin, self.gpio.HIGH)
+        with self.bus:
+            self.gpio.digitalWrite(self.reset_pin, self.gpio.LOW)
+            time.sleep(0.010) # 10ms
+            self.gpio.digitalWrite(self.reset_pin, self.gpio.HIGH)
+            self.invalidate()
 
     def command(self, cmd, cmddata=None):
         # already low
         # self.gpio.digitalWrite(self.dc_pin, self.gpio.LOW)
 
-        if type(cmd) == list:
-            self.spi.writebytes(cmd)
-        else:
-            self.spi.writebytes([cmd])
-
-        if cmddata is not None:
-            if type(cmddata) == list:
-                self.data(cmddata)
+        with self.bus:
+            if type(cmd) == list:
+                self.spi.writebytes(cmd)
             else:
-                self.data([cmddata])
+                self.spi.writebytes([cmd])
+
+            if cmddata is not None:
+                if type(cmddata) == list:
+                    self.data(cmddata)
+                else:
+                    self.data([cmddata])
 
     def data(self, bytes):
-        self.gpio.digitalWrite(self.dc_pin, self.gpio.HIGH)
-        max_xfer = 1024
-        start = 0
-        remaining = len(bytes)
-        while remaining>0:
-            count = remaining if remaining <= max_xfer else max_xfer
-            remaining -= count
-            self.spi.writebytes(bytes[start:start+count])
-            start += count
-        self.gpio.digitalWrite(self.dc_pin, self.gpio.LOW)
+        """Send data bytes, either a list of ints or a buffer
+           (bytearray, memoryview...)"""
+        with self.bus, tracing.span("spi write", "spi"):
+            self.gpio.digitalWrite(self.dc_pin, self.gpio.HIGH)
+            if self.writebuf is not None and not isinstance(bytes, list):
+                # spidev >= 3.5 takes buffers and splits the transfer itself
+                self.writebuf(bytes)
+            else:
+                max_xfer = 1024
+                start = 0
+                remaining = len(bytes)
+                while remaining>0:
+                    count = remaining if remaining <= max_xfer else max_xfer
+                    remaining -= count
+                    chunk = bytes[start:start+count]
+                    if not isinstance(chunk, list):
+                        chunk = list(bytearray(chunk))
+                    self.spi.writebytes(chunk)
+                    start += count
+            self.gpio.digitalWrite(self.dc_pin, self.gpio.LOW)
 
     def begin(self, vcc_state = SWITCH_CAP_VCC):
         time.sleep(0.001) # 1ms
@@ -221,19 +298,36 @@ class SSD1351:
         color = self.encode_color(color)
 
         # set location
-        self.goTo(x, y)
-        self.data([color >> 8, color & 0xFF])
+        with self.bus:
+            self.goTo(x, y)
+            self.invalidate()
+            self.data([color >> 8, color & 0xFF])
 
     def clear(self):
         """Clear display buffer"""
-        self.im = Image.new("RGB", (self.cols, self.rows), 'black')
-        self.draw = ImageDraw.Draw(self.im)
+        if isinstance(self.im, canvas.Canvas):
+            self.im.fill(0)
+        else:
+            self.im.paste((0, 0, 0), (0, 0) + self.im.size)
+
+    @contextlib.contextmanager
+    def target(self, im, draw=None):
+        """Draw on `im` instead of the display buffer"""
+        saved = self.im, self.draw
+        self.im = im
+        if draw is None and not isinstance(im, canvas.Canvas):
+            draw = ImageDraw.Draw(im)
+        self.draw = draw
+        try:
+            yield im
+        finally:
+            self.im, self.draw = saved
 
     def text_center(self, string, color, font=None, size=10):
         if font is None:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/droid/DroidSansMono.ttf", size)
+            font = fonts.get(fonts.DROID_MONO, size)
 
-        text_size = self.draw.textsize(string, font=font)
+        text_size = self.textsize(string, font)
         text_x = max((self.cols-text_size[0])/2, 0)
         text_y = max((self.rows-text_size[1])/2, 0)
         self.draw_text(text_x, text_y, string, color, font=font, size=size)
@@ -241,16 +335,28 @@ class SSD1351:
 
     def text_center_y(self, text_y, string, color, font=None, size=10):
         if font is None:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/droid/DroidSansMono.ttf", size)
+            font = fonts.get(fonts.DROID_MONO, size)
 
-        text_size = self.draw.textsize(string, font=font)
+        text_size = self.textsize(string, font)
         text_x = max((self.cols-text_size[0])/2, 0)
         self.draw_text(text_x, text_y, string, color, font=font, size=size)
         return text_x, text_y
 
+    def textsize(self, string, font):
+        """Text size with a PIL font or a GlyphAtlas"""
+        if isinstance(font, glyphs.GlyphAtlas):
+            return font.textsize(string)
+        if isinstance(self.im, canvas.Canvas):
+            return self.im.textsize(string, font)
+        return self.draw.textsize(string, font=font)
+
     def draw_text(self, x, y, string, color, font=None, size=10):
         if font is None:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/droid/DroidSansMono.ttf", size)
+            font = fonts.get(fonts.DROID_MONO, size)
+        if isinstance(self.im, canvas.Canvas):
+            return self.im.text((x, y), string, color, font)
+        if isinstance(font, glyphs.GlyphAtlas):
+            return font.draw(self.im, (x, y), string, color)
         self.draw.text((x, y), string, font=font, fill=color)
         return self.draw.textsize(string, font=font)
 
@@ -265,17 +371,39 @@ class SSD1351:
 
         # Y bounds check
         if y+h > self.rows:
-            h = self.rows - y - 1
+            h = self.rows - y
 
         # X bounds check
         if x+w > self.cols:
-            w = self.cols - x - 1
+            w = self.cols - x
+
+        pattern = self.fill_pattern(self.encode_color(fillcolor))
+        with self.bus:
+            self.setDisplay(x, y, x+(w-1), y+(h-1))
+            remaining = w*h*2
+            while remaining > 0:
+                count = min(remaining, len(pattern))
+                self.data(pattern[:count])
+                remaining -= count
+            self.invalidate()
+        self.log.debug("fillScreen end")
 
-        self.setDisplay(x, y, x+(w-1), y+(h-1))
-        color = self.encode_color(fillcolor)
+    def drawFastHLine(self, x, y, w, color):
+        self.rawFillRect(x, y, w, 1, color)
 
-        self.data([color >> 8, color & 0xFF] * w*h)
-        self.log.debug("fillScreen end")
+    def drawFastVLine(self, x, y, h, color):
+        self.rawFillRect(x, y, 1, h, color)
+
+    def fill_pattern(self, color):
+        """Buffer of FILL_CHUNK pixels of the RGB565 `color`"""
+        pattern = self.patterns.get(color)
+        if pattern is None:
+            if len(self.patterns) >= self.FILL_PATTERNS:
+                self.patterns.clear()
+            pattern = memoryview(bytearray([color >> 8, color & 0xFF]) *
+                                 self.FILL_CHUNK)
+            self.patterns[color] = pattern
+        return pattern
 
     def setDisplay(self, startx, starty, endx, endy):
         if startx >= self.cols or starty >= self.rows:
@@ -295,18 +423,133 @@ class SSD1351:
         self.command(self.CMD_SETROW, [starty, endy])
         self.command(self.CMD_WRITERAM)
 
-    def im2list(self):
-        """Convert PIL RGB888 Image to SSD1351 RAM buffer"""
-        image = np.array(self.im).reshape(-1, 3)
-        image[:,0] *= 0.121
-        image[:,1] *= 0.247
-        image[:,2] *= 0.121
-        d = np.left_shift(image, [11, 5, 0]).sum(axis=1)
-        data =np.dstack(((d>>8)&0xff, d&0xff)).flatten()
-        return data.tolist()
-
-    def display(self, x=0, y=0, w=None, h=None):
-        """Send display buffer to the device"""
+    def im2buf(self, frame=None, origin=(0, 0), convert=None):
+        """Convert PIL RGB888 Image to SSD1351 RAM buffer
+           (a view on the converter buffer, valid until the next call)
+           convert is the conversion mode, see rgb565.MODES"""
+        if frame is None:
+            frame = self.frame()
+        if frame.ndim == 2:
+            # already RGB565
+            return np.ascontiguousarray(frame).view(np.uint8).ravel()
+        return self.converter.convert(frame, origin, convert)
+
+    def scroll_rows(self, top, rows, step=-1, interval=SCROLL_NORMAL):
+        """Let the panel scroll `rows` rows from `top` by itself,
+           `step` columns (negative: to the left) every `interval`
+
+           Scrolling starts once the next frame has been sent, rows of
+           the band are no longer written to the GRAM while it lasts."""
+        band = (top, rows, step, interval)
+        if self.scroll_want != band:
+            self.log.debug("scroll %s requested" % (band,))
+            self.scroll_want = band
+
+    def stop_scroll(self):
+        """Stop hardware scrolling with the next frame sent"""
+        self.scroll_want = None
+
+    def _stop_scroll(self, rects, regions):
+        """Before writing a frame: stop scrolling if another state is
+           requested, or if the frame changed under the band (the new
+           content is written, then scrolling starts again)"""
+        if self.scroll is None:
+            return
+        top, rows = self.scroll[:2]
+        bottom = top + rows - 1
+        if self.scroll == self.scroll_want and \
+           all(y1 < top or y0 > bottom for x0, y0, x1, y1 in rects):
+            return
+        self.command(self.CMD_STOPSCROLL)
+        self.scroll = None
+        # the band is left shifted in GRAM, it must be rewritten
+        band = (0, top, self.cols, min(top + rows, self.rows))
+        rects.append((0, top, self.cols - 1, band[3] - 1))
+        regions.append(band)
+
+    def _start_scroll(self):
+        """After writing a frame: start the requested scrolling"""
+        if self.scroll is None and self.scroll_want is not None:
+            top, rows, step, interval = self.scroll_want
+            self.command(self.CMD_HORIZSCROLL,
+                         [step & 0xFF, top, rows, 0x00, interval])
+            self.command(self.CMD_STARTSCROLL)
+            self.scroll = self.scroll_want
+
+    def _outside_scroll(self, rects):
+        """Cut the scrolling band out of the GRAM windows"""
+        if self.scroll is None:
+            return rects
+        top, rows = self.scroll[:2]
+        bottom = top + rows - 1
+        clipped = []
+        for x0, y0, x1, y1 in rects:
+            if y1 < top or y0 > bottom:
+                clipped.append((x0, y0, x1, y1))
+                continue
+            if y0 < top:
+                clipped.append((x0, y0, x1, top - 1))
+            if y1 > bottom:
+                clipped.append((x0, bottom + 1, x1, y1))
+        return clipped
+
+    def invalidate(self):
+        """Forget the last frame sent, next display() will be a full refresh"""
+        self.last_frame = None
+
+    def dirty_rects(self, changed):
+        """Group changed pixels into a few (x0, y0, x1, y1) GRAM windows"""
+        rows = np.flatnonzero(changed.any(axis=1))
+        if rows.size == 0:
+            return []
+        rects = []
+        for y0, y1 in self._spans(rows):
+            cols = np.flatnonzero(changed[y0:y1+1].any(axis=0))
+            for x0, x1 in self._spans(cols):
+                rects.append((x0, y0, x1, y1))
+
+        # every window costs a few commands, merge the cheapest pairs
+        while len(rects) > self.MAX_WINDOWS:
+            best = None
+            for i in range(len(rects)):
+                for j in range(i+1, len(rects)):
+                    a, b = rects[i], rects[j]
+                    u = (min(a[0], b[0]), min(a[1], b[1]),
+                         max(a[2], b[2]), max(a[3], b[3]))
+                    cost = self._area(u) - self._area(a) - self._area(b)
+                    if best is None or cost < best[0]:
+                        best = (cost, i, j, u)
+            cost, i, j, u = best
+            rects[i] = u
+            del rects[j]
+        return rects
+
+    def _spans(self, idx):
+        """Split sorted indexes into (first, last) runs,
+           bridging gaps smaller than MERGE_GAP"""
+        breaks = np.flatnonzero(np.diff(idx) > self.MERGE_GAP)
+        starts = [idx[0]] + [idx[b+1] for b in breaks]
+        ends = [idx[b] for b in breaks] + [idx[-1]]
+        return [(int(s), int(e)) for s, e in zip(starts, ends)]
+
+    def _area(self, rect):
+        return (rect[2] - rect[0] + 1) * (rect[3] - rect[1] + 1)
+
+    def display(self, x=0, y=0, w=None, h=None, regions=None, convert=None,
+                done=None):
+        """Send display buffer to the device
+
+           Only the areas that changed since the last call are sent,
+           nothing at all if the frame is the same.
+           regions is an optional list of (x0, y0, x1, y1) boxes
+           (x1 and y1 excluded) where the frame may have changed,
+           the rest of the frame is not even looked at.
+           convert is the RGB565 conversion mode of this frame (see
+           rgb565.MODES), self.converter.mode by default.
+           With a Transfer thread running, the frame is handed off to it
+           and sent in the background.
+           done is called once the frame is sent (or once it is known
+           there is nothing to send), from the Transfer thread if any."""
         self.log.debug("disp in")
         if h is None:
             h = self.rows
@@ -317,20 +560,97 @@ class SSD1351:
         y = max(y, 0)
         w = min(w, self.cols)
         h = min(h, self.rows)
-        if w-x < 0:
+        if w-x <= 0 or h-y <= 0:
             return
-        self.log.debug("set display")
-        self.setDisplay(x, y, w-1, h-1)
-        self.log.debug("set display end")
-        data = []
-        start = y * self.cols + x
-        end = h * self.cols + w
-        self.log.debug("get data")
-
-        self.data(self.im2list())
+        if regions is not None:
+            regions = [(max(x0, x), max(y0, y), min(x1, w), min(y1, h))
+                       for x0, y0, x1, y1 in regions]
+            regions = [r for r in regions if r[2] > r[0] and r[3] > r[1]]
+            if not regions and self.last_frame is not None and \
+               self.scroll == self.scroll_want:
+                self.log.debug("disp out, nothing to do")
+                if done is not None:
+                    done()
+                return
+        frame = self.frame()
+        if self.sender is not None:
+            self.sender.submit(frame, (x, y, w, h), regions, convert, done)
+        else:
+            self.send(frame, (x, y, w, h), regions, convert)
+            if done is not None:
+                done()
         self.log.debug("disp out")
 
-    @tools.timed
+    def frame(self):
+        """Copy of the display buffer in the back frame buffer: a RGB888
+           array, or a RGB565 one with a canvas"""
+        if isinstance(self.im, canvas.Canvas):
+            src = self.im.buf
+        else:
+            src = np.asarray(self.im)
+        back = self.buffers[self.back]
+        if back is None or back.shape != src.shape or back.dtype != src.dtype:
+            back = self.buffers[self.back] = np.empty_like(src)
+        elif self.sender is not None:
+            # still on its way to the panel, from two frames ago
+            self.sender.release(back)
+        np.copyto(back, src)
+        self.back ^= 1
+        return back
+
+    def send(self, frame, box, regions=None, convert=None):
+        """Send the changed areas of frame (a RGB888 array, or a RGB565
+           one sent as is) within box (x, y, w, h) or regions"""
+        x, y, w, h = box
+        with self.bus:
+            if self.last_frame is None or regions is None:
+                regions = [box]
+            regions = list(regions)
+            if self.last_frame is None:
+                self.last_frame = np.zeros_like(frame)
+                rects = [(x, y, w-1, h-1)]
+            else:
+                rects = []
+                for x0, y0, x1, y1 in regions:
+                    changed = (frame[y0:y1, x0:x1] !=
+                               self.last_frame[y0:y1, x0:x1])
+                    if changed.ndim == 3:
+                        changed = changed.any(axis=2)
+                    rects.extend((rx0+x0, ry0+y0, rx1+x0, ry1+y0)
+                                 for rx0, ry0, rx1, ry1 in self.dirty_rects(changed))
+            self._stop_scroll(rects, regions)
+            rects = self._outside_scroll(rects)
+            self.log.debug("dirty rects: %s" % (rects,))
+
+            start = time.time()
+            converting = 0
+            sent = 0
+            for x0, y0, x1, y1 in rects:
+                t = time.time()
+                buf = self.im2buf(frame[y0:y1+1, x0:x1+1], (x0, y0), convert)
+                converting += time.time() - t
+                self.setDisplay(x0, y0, x1, y1)
+                self.data(buf)
+                sent += len(buf)
+            CONVERT_TIME.observe(converting)
+            SPI_TIME.observe(time.time() - start - converting)
+            FRAMES.inc()
+            PIXEL_BYTES.inc(sent)
+            self._start_scroll()
+            if regions == [(0, 0, self.cols, self.rows)]:
+                np.copyto(self.last_frame, frame)
+            else:
+                for x0, y0, x1, y1 in regions:
+                    self.last_frame[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+
+    def start_transfer(self):
+        """Send frames from a background Transfer thread"""
+        if self.sender is None:
+            self.sender = Transfer(self)
+            self.sender.start()
+        return self.sender
+
+    @tracing.traced
     def dump_disp(self):
         """Dump display buffer on screen,
            for debugging purpose"""
@@ -354,7 +674,7 @@ class SSD1351:
                         txt[idx] = ' '
             print ''.join(txt) + '║'
 
-    @tools.timed
+    @tracing.traced
     def dump_disp2(self):
         #image = list(self.im.convert("I").getdata())
         image = np.array(self.im)
@@ -375,13 +695,129 @@ class SSD1351:
             print ''.join(txt) + '║'
 
 
+class Transfer(threading.Thread):
+    """Convert and send frames in the background
+
+       The main thread renders the next frame while this one streams the
+       previous one. Only the latest frame waits to be sent: a frame
+       submitted while another one is pending replaces it (a drop),
+       a frame submitted while a transfer is running is an overrun.
+       Frames come in turn from two buffers: the one being sent is not
+       written again before the transfer ends (see release())."""
+
+    def __init__(self, oled):
+        super(Transfer, self).__init__()
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.oled = oled
+        self.daemon = True
+        self.must_stop = threading.Event()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = None
+        self.busy = False
+        # frame being sent
+        self.sending = None
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.overruns = 0
+        self.last_time = 0
+        self.max_time = 0
+
+    def submit(self, frame, box, regions=None, convert=None, done=None):
+        done = [] if done is None else [done]
+        with self.lock:
+            self.submitted += 1
+            if self.busy:
+                self.overruns += 1
+                FRAME_OVERRUNS.inc()
+            if self.pending is not None:
+                # the dropped frame damage must be sent with this one
+                self.dropped += 1
+                FRAMES_DROPPED.inc()
+                old_box, old_regions = self.pending[1:3]
+                if old_box != box or old_regions is None or regions is None:
+                    box = (0, 0, self.oled.cols, self.oled.rows)
+                    regions = None
+                else:
+                    regions = old_regions + regions
+                # so are its callbacks
+                done = self.pending[4] + done
+            self.pending = (frame, box, regions, convert, done)
+            self.ready.notify()
+
+    def run(self):
+        self.log.debug("%s thread started" % self.name)
+        while True:
+            with self.lock:
+                while self.pending is None and not self.must_stop.is_set():
+                    self.ready.wait()
+                if self.pending is None:
+                    break
+                frame, box, regions, convert, done = self.pending
+                self.pending = None
+                self.busy = True
+                self.sending = frame
+            start = time.time()
+            try:
+                with tracing.span("transfer", "spi"):
+                    self.oled.send(frame, box, regions, convert)
+            except Exception, e:
+                self.log.exception(e)
+                self.oled.invalidate()
+            elapsed = time.time() - start
+            with self.lock:
+                self.busy = False
+                self.sending = None
+                self.sent += 1
+                self.last_time = elapsed
+                self.max_time = max(self.max_time, elapsed)
+                self.ready.notify_all()
+            for callback in done:
+                callback()
+
+    def release(self, frame):
+        """Wait until `frame` is not being sent, before it is written
+           again"""
+        with self.lock:
+            while self.sending is frame and self.is_alive():
+                self.ready.wait()
+
+    def flush(self, timeout=None):
+        """Wait until every submitted frame is sent"""
+        with self.lock:
+            end = None if timeout is None else time.time() + timeout
+            while (self.pending is not None or self.busy) and self.is_alive():
+                if end is not None and time.time() >= end:
+                    return False
+                self.ready.wait(None if end is None else end - time.time())
+        return True
+
+    def stop(self):
+        """Send the pending frame and stop,
+           the display goes back to synchronous transfers"""
+        self.log.debug("%s request stop" % self.name)
+        self.must_stop.set()
+        with self.lock:
+            self.ready.notify_all()
+        if threading.current_thread() is not self:
+            self.join(1)
+        self.oled.sender = None
+
+    def stats(self):
+        with self.lock:
+            return {"submitted": self.submitted, "sent": self.sent,
+                    "dropped": self.dropped, "overruns": self.overruns,
+                    "last_ms": self.last_time * 1000,
+                    "max_ms": self.max_time * 1000}
+
+
 if __name__ == '__main__':
     import datetime
     import time
     import ssd1351
     import random
     from PIL import ImageFont
-    import psutil
     import logging
     import os
 
@@ -406,3 +842,12 @@ if __name__ == '__main__':
         led.rawFillRect(color_width*2, x, color_width*3, bands, color&0xff)
         color = (color + (color_step << 16) + (color_step << 8) + (color_step)) & 0xFFFFFF
 
+    # same gradients, smooth: drawn in the buffer and dithered
+    time.sleep(2)
+    for x in range(led.cols):
+        level = x * 0xFF / (led.cols - 1)
+        led.draw.line([(x, 0), (x, led.rows/3 - 1)], fill=(level, 0, 0))
+        led.draw.line([(x, led.rows/3), (x, 2*led.rows/3 - 1)], fill=(0, level, 0))
+        led.draw.line([(x, 2*led.rows/3), (x, led.rows - 1)], fill=(0, 0, level))
+    led.display(convert="dither")
+
@@ -6,16 +6,33 @@ import glob
 import logging
 import threading
 import time
-import psutil
-from mpd import MPDClient, ConnectionError
-import alsaaudio
-from pythonwifi.iwlibs import Wireless
 import select
-import RPi.GPIO as gpio
 import socket
 import struct
 import fcntl
-
+from collections import deque
+import backends
+import events
+import reactor
+import tools
+import tracing
+# hardware and services libraries are only needed by the threads
+# using them, so this module can be loaded off the Pi
+try:
+    from mpd import MPDClient, ConnectionError
+except ImportError:
+    MPDClient = None
+    ConnectionError = IOError
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+try:
+    from pythonwifi.iwlibs import Wireless
+except ImportError:
+    Wireless = None
+
+gpio = backends.rpi_gpio()
 gpio.setmode(gpio.BCM)
 
 
@@ -27,117 +44,381 @@ class Thread(threading.Thread):
         self.must_stop = threading.Event()
         self.lock = threading.Lock()
         self.daemon = True
+        self.bus = events.bus
+
+    def publish(self, topic, value=None):
+        """Tell the main loop something changed"""
+        self.bus.publish(topic, value)
 
     def stop(self):
         self.log.debug("%s request stop" % self.name)
         self.must_stop.set()
 
 
-class HWmonitor(Thread):
-    """docstring for HWmonitor"""
+class Source(object):
+    """Event source driven by the reactor thread
+
+       start() registers its file descriptors, whose handlers must not
+       block, stop() unregisters them and closes the ones it opened."""
+
     def __init__(self):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.log.setLevel(logging.DEBUG)
+        self.lock = threading.Lock()
+        self.bus = events.bus
+        self.reactor = reactor.reactor
+        self.fds = []
+        # fds opened by the source itself, closed by stop()
+        self.owned = []
+
+    def publish(self, topic, value=None):
+        """Tell the main loop something changed"""
+        self.bus.publish(topic, value)
+
+    def register(self, fd, mask, callback, owned=False):
+        """Watch fd, closed on stop() if owned (fds of a library object,
+           like a socket, are closed with the object)"""
+        self.reactor.register(fd, mask, callback)
+        self.fds.append(fd)
+        if owned:
+            self.owned.append(fd)
+
+    def start(self):
+        """Register the file descriptors, none by default"""
+        pass
+
+    def stop(self):
+        self.log.debug("%s request stop" % self.__class__.__name__)
+        for fd in self.fds:
+            self.reactor.unregister(fd)
+        for fd in self.owned:
+            os.close(fd)
+        self.fds = []
+        self.owned = []
+
+
+class HWmonitor(Source):
+    """CPU load and wifi signal, sampled from /proc on the reactor
+
+       The /proc files are kept open and read again from the start on
+       every sample. The IP address is read once and kept until netlink
+       tells an address or a route changed."""
+    # seconds between two samples
+    INTERVAL = 5
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    SIOCGIFADDR = 0x8915
+
+    def __init__(self, ifname="wlan0"):
         super(HWmonitor, self).__init__()
+        self.ifname = ifname
         self.cpu = 0
         self.wifi_signal = 0
-        self.wifi = Wireless('wlan0')
-
-    def run(self):
-        self.log.debug("%s thread started" % self.name)
-        while not self.must_stop.is_set():
-            cpu = psutil.cpu_percent()
-            stat, qual, discard, missed_beacon = self.wifi.getStatistics()
-            self.lock.acquire()
-            self.cpu = cpu
-            self.wifi_signal = qual.signallevel
-            self.lock.release()
-            self.must_stop.wait(5)
+        self.wifi = Wireless(ifname) if Wireless is not None else None
+        self.stat = os.open("/proc/stat", os.O_RDONLY)
+        try:
+            self.wireless = os.open("/proc/net/wireless", os.O_RDONLY)
+        except OSError:
+            # no wireless extensions
+            self.wireless = None
+        # busy and total jiffies at the last sample, None before the
+        # first one
+        self.jiffies = None
+        # for the SIOCGIFADDR ioctl
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ips = {}
+        self.netlink = None
+        self.running = False
+        self.samples = 0
+        self.ip_reads = 0
+
+    def start(self):
+        self.running = True
+        try:
+            self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                         0)  # NETLINK_ROUTE
+            self.netlink.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR |
+                               self.RTMGRP_IPV4_ROUTE))
+            self.netlink.setblocking(False)
+            self.register(self.netlink.fileno(), select.EPOLLIN,
+                          self.on_netlink)
+        except (socket.error, AttributeError), e:
+            # no netlink: the address is read every time
+            self.log.warning("no netlink notifications: %s" % e)
+            self.netlink = None
+        self.reactor.call_later(0, self.sample)
+
+    def sample(self):
+        if not self.running:
+            return
+        # first, so a failed read does not end the sampling
+        self.reactor.call_later(self.INTERVAL, self.sample)
+        with tracing.span("hwmonitor", "worker"):
+            cpu = self.read_cpu()
+            signal = self.read_signal()
+        with self.lock:
+            if cpu is not None:
+                self.cpu = cpu
+            self.wifi_signal = signal
+            self.samples += 1
+        if cpu is not None:
+            self.publish(events.CPU, cpu)
+        self.publish(events.WIFI, signal)
+
+    @staticmethod
+    def read(fd, size=512):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, size)
+
+    def read_cpu(self):
+        """CPU load since the last call, %, None on the first call
+           (there is nothing to compare with but the boot)"""
+        # cpu  user nice system idle iowait irq softirq steal ...
+        line = self.read(self.stat, 256).split("\n", 1)[0]
+        values = [int(v) for v in line.split()[1:]]
+        idle = values[3] + values[4]
+        total = sum(values[:8])
+        busy = total - idle
+        last = self.jiffies
+        self.jiffies = (busy, total)
+        if last is None:
+            return None
+        last_busy, last_total = last
+        if total <= last_total:
+            return 0
+        return round(100.0 * (busy - last_busy) / (total - last_total), 1)
+
+    def read_signal(self):
+        """Wifi signal level, %, 0 without the interface"""
+        # wlan0: 0000   70.  -40.  -256  ...
+        if self.wireless is None:
+            return 0
+        data = self.read(self.wireless, 1024)
+        start = data.find(" %s:" % self.ifname)
+        if start < 0:
+            start = data.find("\n%s:" % self.ifname)
+        if start < 0:
+            return 0
+        fields = data[start:data.find("\n", start + 1)].split()
+        level = int(float(fields[3]))
+        if level < 0:
+            # dBm, -100 dBm is nothing, -50 dBm is a full signal
+            return max(0, min(100, 2 * (level + 100)))
+        return min(level, 100)
+
+    def on_netlink(self, fd, mask):
+        try:
+            while self.netlink.recv(8192):
+                pass
+        except socket.error:
+            # drained
+            pass
+        with self.lock:
+            self.ips.clear()
 
     def get_ip_address(self, ifname):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-	try:
-            return socket.inet_ntoa(fcntl.ioctl(
-                s.fileno(),
-                0x8915,  # SIOCGIFADDR
+        with self.lock:
+            if ifname in self.ips:
+                return self.ips[ifname]
+        try:
+            ip = socket.inet_ntoa(fcntl.ioctl(
+                self.sock.fileno(),
+                self.SIOCGIFADDR,
                 struct.pack('256s', ifname[:15])
               )[20:24])
-	except:
-	    return None
+        except IOError:
+            ip = None
+        with self.lock:
+            self.ip_reads += 1
+            if self.netlink is not None:
+                self.ips[ifname] = ip
+        return ip
+
+    def essid(self):
+        if self.wifi is None:
+            return None
+        return self.wifi.getEssid()
+
+    def stop(self):
+        super(HWmonitor, self).stop()
+        self.running = False
+        if self.netlink is not None:
+            self.netlink.close()
+        for fd in (self.stat, self.wireless):
+            if fd is not None:
+                os.close(fd)
+        self.stat = self.wireless = None
+        self.sock.close()
+
+    def stats(self):
+        with self.lock:
+            return {"samples": self.samples, "ip_reads": self.ip_reads}
 
 
 class MPlayerControl(Thread):
-    def __init__(self, action=None, arg=None):
+    """MPD command worker
+
+       Commands are queued and sent by this single thread, over one
+       connection kept open (and reopened when mpd drops it). A queued
+       command replaces a pending one of the same kind when only the last
+       one matters (a burst of volume changes sends the last volume
+       only). Any new command cancels a running sleep or rise."""
+    # commands superseded by the next one of the same kind
+    COALESCE = ("vol", "play", "stop")
+
+    def __init__(self, host="localhost", port=6600):
         super(MPlayerControl, self).__init__()
+        self.host = host
+        self.port = port
         self.mpd = MPDClient()
-	try:
-            self.mpd.connect("localhost", 6600)
-	except:
-	    self.action = "nothing"
-	else:
-            self.action = action
-            self.arg = arg
+        self.connected = False
+        self.queue = deque()
+        self.pending = threading.Condition(self.lock)
+        self.cancel = threading.Event()
+        self.sent = 0
+        self.coalesced = 0
+        self.reconnects = 0
+
+    def submit(self, action, arg=None):
+        with self.lock:
+            if action in self.COALESCE:
+                for i, (queued, _) in enumerate(self.queue):
+                    if queued == action:
+                        del self.queue[i]
+                        self.coalesced += 1
+                        break
+            self.queue.append((action, arg))
+            self.cancel.set()
+            self.pending.notify()
+
+    def stop(self):
+        super(MPlayerControl, self).stop()
+        with self.lock:
+            self.cancel.set()
+            self.pending.notify()
 
     def run(self):
         self.log.debug("%s thread started" % self.name)
-        if self.action is "play":
-            self.log.debug("play")
-            if self.arg:
-                self.mpd.play(self.arg)
-            else:
-                self.mpd.play()
-        if self.action is "stop":
-            self.log.debug("stop playing")
-            self.mpd.stop()
-        if self.action is "next":
-            self.log.debug("next track")
-            self.mpd.next()
-        if self.action is "prev":
-            self.log.debug("previous track")
-            self.mpd.previous()
-
-        if self.action is "sleep":
-            # get current volume
-            volume = int(self.mpd.status()['volume'])
-            if volume > 50:
-                step = (volume - 50) / 120.0
-            self.log.debug("sleeping mode for 120min (using step: %.2f)" % step)
-            while volume > 50 and not self.must_stop.is_set():
-                self.must_stop.wait(60)
-                volume -= step
-                self.mpd.setvol(int(volume))
-            self.mpd.stop()
-            self.log.debug("sleeping complete")
-
-        if self.action is "rise":
-            # minimum audible volume is ~ 50, max is 95
-            # raise volume every minute for 20 minutes
-            step = (95 - 50) / 20
-            volume = 50
-            self.mpd.setvol(volume)
-            # load "clock" playlist and play song n4
-            self.mpd.clear()
-            self.mpd.load("clock")
-            self.mpd.play(7)
-            self.log.debug("play song 4, and raising volume...")
-            while volume < (50 + step*20) and not self.must_stop.is_set():
-                self.must_stop.wait(60)
-                volume += step
-                self.mpd.setvol(volume)
-            self.log.debug("rising complete")
-        if self.action is "vol":
-            volume = int(self.arg)
-            self.log.debug("changing volume %d" % volume)
-            self.mpd.setvol(volume)
-        self.mpd.close()
+        while True:
+            with self.lock:
+                while not self.queue and not self.must_stop.is_set():
+                    self.pending.wait()
+                if self.must_stop.is_set():
+                    break
+                action, arg = self.queue.popleft()
+                if not self.queue:
+                    self.cancel.clear()
+            try:
+                with tracing.span("mpd " + action, "mpd"):
+                    getattr(self, "do_" + action)(arg)
+            except Exception, e:
+                self.log.warning("%s failed: %s" % (action, e))
+        self.disconnect()
+
+    def call(self, command, *args):
+        """Send a command, reconnecting once if the connection was lost"""
+        for attempt in (0, 1):
+            if not self.connected:
+                self.mpd.connect(self.host, self.port)
+                self.connected = True
+            try:
+                result = getattr(self.mpd, command)(*args)
+                self.sent += 1
+                return result
+            except (ConnectionError, socket.error), e:
+                # mpd closes idle connections after a while
+                self.disconnect()
+                if attempt:
+                    raise
+                self.reconnects += 1
+                self.log.debug("reconnecting to mpd (%s)" % e)
+
+    def disconnect(self):
+        if self.connected:
+            try:
+                self.mpd.disconnect()
+            except (ConnectionError, socket.error):
+                pass
+        self.connected = False
 
+    def stats(self):
+        with self.lock:
+            return {"sent": self.sent, "coalesced": self.coalesced,
+                    "reconnects": self.reconnects, "queued": len(self.queue)}
 
-class MPlayer(Thread):
-    """docstring for MPlayer"""
-    def __init__(self):
+    def do_play(self, pos):
+        self.log.debug("play")
+        if pos:
+            self.call("play", pos)
+        else:
+            self.call("play")
+
+    def do_stop(self, arg):
+        self.log.debug("stop playing")
+        self.call("stop")
+
+    def do_next(self, arg):
+        self.log.debug("next track")
+        self.call("next")
+
+    def do_prev(self, arg):
+        self.log.debug("previous track")
+        self.call("previous")
+
+    def do_vol(self, volume):
+        self.log.debug("changing volume %d" % volume)
+        self.call("setvol", int(volume))
+
+    def do_sleep(self, arg):
+        # get current volume
+        volume = int(self.call("status")['volume'])
+        step = 0
+        if volume > 50:
+            step = (volume - 50) / 120.0
+        self.log.debug("sleeping mode for 120min (using step: %.2f)" % step)
+        while volume > 50:
+            if self.cancel.wait(60):
+                self.log.debug("sleeping cancelled")
+                return
+            volume -= step
+            self.call("setvol", int(volume))
+        self.call("stop")
+        self.log.debug("sleeping complete")
+
+    def do_rise(self, arg):
+        # minimum audible volume is ~ 50, max is 95
+        # raise volume every minute for 20 minutes
+        step = (95 - 50) / 20
+        volume = 50
+        self.call("setvol", volume)
+        # load "clock" playlist and play song n4
+        self.call("clear")
+        self.call("load", "clock")
+        self.call("play", 7)
+        self.log.debug("play song 4, and raising volume...")
+        while volume < (50 + step*20):
+            if self.cancel.wait(60):
+                self.log.debug("rising cancelled")
+                return
+            volume += step
+            self.call("setvol", volume)
+        self.log.debug("rising complete")
+
+
+class MPlayer(Source):
+    """mpd state, followed through an idle command on the reactor"""
+    # seconds between two reconnection attempts
+    RECONNECT = 5
+
+    def __init__(self, host="localhost", port=6600):
         super(MPlayer, self).__init__()
         self.title = ""
         # MPlayer daemon
+        self.host = host
+        self.port = port
         self.mpd = MPDClient()
-        self.mpd.connect("localhost", 6600)
+        self.mpd.connect(self.host, self.port)
         self.status = self.mpd.status()
         if self.status['state'] == "play":
             song = self.mpd.currentsong()
@@ -146,200 +427,443 @@ class MPlayer(Thread):
             elif 'title' in song and 'artist' in song:
                 self.title = "%s - %s" % (song['title'], song['artist'], )
         self.playlist = self.mpd.playlistinfo()
-        self.mpc = None
+        self.mpc = MPlayerControl()
+        self.publish(events.PLAYER, (self.status['state'], self.title))
+
+    def idle(self):
+        """Ask mpd to tell when something changes"""
+        self.mpd.send_idle()
+        self.register(self.mpd.fileno(), select.EPOLLIN, self.on_idle)
+
+    def on_idle(self, fd, mask):
+        try:
+            changes = self.mpd.fetch_idle()
+            self.log.debug("events: %s" % changes)
+            with tracing.span("mpd idle", "worker"):
+                self.update(changes)
+            self.mpd.send_idle()
+        except (ConnectionError, socket.error), e:
+            self.log.warning("lost connection (%s), reconnecting..." % e)
+            self.reactor.unregister(fd)
+            self.fds.remove(fd)
+            self.reconnect()
+
+    def reconnect(self):
+        try:
+            self.mpd.disconnect()
+        except (ConnectionError, socket.error):
+            pass
+        try:
+            self.mpd.connect(self.host, self.port)
+            self.update(("player", "playlist"))
+            self.idle()
+        except (ConnectionError, socket.error), e:
+            self.log.warning("cannot reconnect: %s" % e)
+            self.reactor.call_later(self.RECONNECT, self.reconnect)
+
+    def update(self, changes):
+        """Read what changed in mpd"""
+        if 'player' in changes:
+            status = self.mpd.status()
+            title = ""
+            if status['state'] == "play":
+                song = self.mpd.currentsong()
+                if 'title' in song and 'name' in song:
+                    title = "%s - %s" % (song['title'], song['name'])
+                elif 'title' in song and 'artist' in song:
+                    title = "%s - %s" % (song['title'], song['artist'])
+            self.log.debug("mpd event: %s state: %s song: %s"
+                           % (changes, status['state'], title))
+            self.lock.acquire()
+            self.title = title
+            self.status = status
+            self.lock.release()
+            self.publish(events.PLAYER, (status['state'], title))
+        if 'playlist' in changes:
+            with self.lock:
+                self.playlist = self.mpd.playlistinfo()
+                self.log.debug("updating playlist")
+            self.publish(events.PLAYLIST, self.playlist)
 
-    def run(self):
-        self.log.debug("%s thread started" % self.name)
-        while not self.must_stop.is_set():
-            try:
-                events = self.mpd.idle()
-                self.log.debug("events: %s" % events)
-                if 'player' in events:
-                    status = self.mpd.status()
-                    title = ""
-                    if status['state'] == "play":
-                        song = self.mpd.currentsong()
-                        if 'title' in song and 'name' in song:
-                            title = "%s - %s" % (song['title'], song['name'])
-                        elif 'title' in song and 'artist' in song:
-                            title = "%s - %s" % (song['title'], song['artist'])
-                    self.log.debug("mpd event: %s state: %s song: %s"
-                                   % (events, status['state'], title))
-                    self.lock.acquire()
-                    self.title = title
-                    self.status = status
-                    self.lock.release()
-                if 'playlist' in events:
-                    with self.lock:
-                        self.playlist = self.mpd.playlistinfo()
-                        self.log.debug("updating playlist")
-            except ConnectionError, e:
-                # reconnect
-                if self.must_stop.is_set():
-                    break
-                self.log.warning("lost connection, reconnecting...")
-                self.mpd.connect("localhost", 6600)
-                title = ""
+    def start(self):
+        self.mpc.start()
+        self.idle()
 
     def stop(self):
         super(MPlayer, self).stop()
+        self.mpc.stop()
         self.mpd.close()
 
     def play(self, pos=None):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("play", pos)
-        self.mpc.start()
+        self.mpc.submit("play", pos)
 
     def next(self):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("next")
-        self.mpc.start()
+        self.mpc.submit("next")
 
     def prev(self):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("prev")
-        self.mpc.start()
+        self.mpc.submit("prev")
 
     def rise(self):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("rise")
-        self.mpc.start()
+        self.mpc.submit("rise")
 
     def sleep(self):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("sleep")
-        self.mpc.start()
+        self.mpc.submit("sleep")
 
     def vol(self, volume):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
         if volume <= 100 and volume >= 0:
-            self.mpc = MPlayerControl("vol", volume)
-            self.mpc.start()
+            self.mpc.submit("vol", volume)
 
     def stop_playing(self):
-        if self.mpc and self.mpc.is_alive():
-            self.mpc.must_stop.set()
-        self.mpc = MPlayerControl("stop")
-        self.mpc.start()
+        self.mpc.submit("stop")
 
 
 class TempNode(Thread):
+    """DS18x20 1-Wire temperature sensors
+
+       Every sensor found is read on each round. Where the w1 masters
+       support it (therm_bulk_read), one conversion is started on all of
+       them at once; otherwise every read does its own conversion. The
+       kernel serialises each master and the conversion is already done,
+       so the sensors are read one after the other. A reading failing its
+       CRC is retried after a growing delay. The rounds come closer while the
+       temperature moves, and spread out while it does not."""
+    W1 = "/sys/bus/w1/devices"
+    FAMILIES = ("10", "22", "28", "3b", "42")
+    # seconds between two rounds
+    MIN_INTERVAL = 30
+    MAX_INTERVAL = 60*5
+    # change between two rounds, °C
+    MOVING = 0.5
+    STEADY = 0.125
+    # attempts after a failed read, the first one BACKOFF s later,
+    # then twice as long every time
+    RETRIES = 3
+    BACKOFF = 0.1
+    # 12 bits conversion time, seconds
+    CONVERSION = 0.75
+
     def __init__(self, addr=None):
         super(TempNode, self).__init__()
+        self.sensors = self.autodetect()
         if addr is None:
-            self.device = self.autodetect()
+            self.device = self.sensors[0]
         else:
             self.device = self.get_device(addr)
         self.temp = 0
+        self.temps = {}
+        self.interval = self.MIN_INTERVAL
+        self.rounds = 0
+        self.bulk = 0
+        self.crc_errors = 0
+        self.failures = 0
 
     def run(self):
         self.log.debug("%s thread started" % self.name)
         while not self.must_stop.is_set():
-            temp = self.read_temp()
-            self.lock.acquire()
-            self.temp = temp
-            self.lock.release()
-            self.must_stop.wait(60*5)
+            with tracing.span("temp read", "worker"):
+                temps = self.read_all()
+            self.adapt(temps)
+            with self.lock:
+                self.temps.update(temps)
+                self.rounds += 1
+                temp = temps.get(self.device)
+                if temp is not None:
+                    self.temp = temp
+            for sensor in sorted(temps):
+                self.publish(events.SENSOR, (sensor, temps[sensor]))
+            if temp is not None:
+                self.publish(events.TEMP, temp)
+            self.must_stop.wait(self.interval)
 
     def autodetect(self):
-        base_dir = '/sys/bus/w1/devices/'
-        device_folder = glob.glob(base_dir + '28*')[0]
-        return os.path.join(device_folder, 'w1_slave')
+        """Ids of the temperature sensors on the bus"""
+        sensors = sorted(os.path.basename(path) for family in self.FAMILIES
+                         for path in glob.glob("%s/%s-*" % (self.W1, family)))
+        if not sensors:
+            raise IOError("no 1-Wire temperature sensor")
+        return sensors
 
     def get_device(self, addr):
+        if addr not in self.sensors:
+            raise IOError("no 1-Wire sensor %s" % addr)
+        return addr
+
+    def read_all(self):
+        """Temperature of every sensor read, {id: °C}"""
+        if self.convert():
+            self.bulk += 1
+        temps = {}
+        for sensor in self.sensors:
+            if self.must_stop.is_set():
+                break
+            temp = self.read_temp(sensor)
+            if temp is not None:
+                temps[sensor] = temp
+        return temps
+
+    def convert(self):
+        """Start a conversion on all the sensors of the bulk capable
+           masters and wait until it is done, False if there is none"""
+        masters = []
+        for path in glob.glob(self.W1 + "/w1_bus_master*/therm_bulk_read"):
+            try:
+                with open(path, "w") as f:
+                    f.write("trigger\n")
+                masters.append(path)
+            except IOError, e:
+                self.log.warning("bulk conversion on %s: %s" % (path, e))
+        if not masters:
+            return False
+        # -1 while the conversion runs, done at the latest after
+        # CONVERSION
+        end = time.time() + self.CONVERSION
+        while not self.must_stop.is_set():
+            self.must_stop.wait(0.05)
+            if time.time() >= end:
+                break
+            pending = False
+            for path in masters:
+                with open(path) as f:
+                    pending = pending or f.read().strip() == "-1"
+            if not pending:
+                break
+        return True
+
+    def read_temp(self, sensor):
+        """Temperature of sensor, °C, None if it cannot be read"""
+        path = os.path.join(self.W1, sensor, "w1_slave")
+        delay = self.BACKOFF
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                self.must_stop.wait(delay)
+                delay *= 2
+            try:
+                with open(path, 'r') as f:
+                    raw = f.readlines()
+            except IOError, e:
+                self.log.warning("%s: %s" % (sensor, e))
+                continue
+            temp = self.parse(sensor, raw)
+            if temp is not None:
+                self.log.debug("%s temp: %.2f°C" % (sensor, temp))
+                return temp
+        with self.lock:
+            self.failures += 1
+        self.log.warning("%s: no valid reading after %d tries"
+                         % (sensor, self.RETRIES + 1))
         return None
 
-    def read_temp(self):
-        with open(self.device, 'r') as f:
-            raw = f.readlines()
-        crc = raw[0].strip()[-3:]
-        if crc == 'YES':
-            temp_pos = raw[1].find("t=")
-            if temp_pos != -1:
-                temp_raw = raw[1][temp_pos+2:]
-                temp_c = float(temp_raw) / 1000.0
-                self.log.debug("temp: %.2f°C" % (temp_c,))
-                return temp_c
-        else:
-            self.log.warning("crc: %s" % crc)
+    def parse(self, sensor, raw):
+        # 72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        # 72 01 4b 46 7f ff 0e 10 57 t=23125
+        crc = raw[0].strip()[-3:] if raw else ""
+        if crc != 'YES':
+            with self.lock:
+                self.crc_errors += 1
+            self.log.debug("%s crc: %s" % (sensor, crc))
+            return None
+        temp_pos = raw[1].find("t=") if len(raw) > 1 else -1
+        if temp_pos == -1:
+            return None
+        value = int(raw[1][temp_pos+2:])
+        if value == 85000:
+            # power on value: the conversion did not happen
+            return None
+        return value / 1000.0
+
+    def adapt(self, temps):
+        """Next interval, from how much the temperatures changed"""
+        changes = [abs(temp - self.temps[sensor])
+                   for sensor, temp in temps.items() if sensor in self.temps]
+        if not changes:
+            return
+        change = max(changes)
+        if change >= self.MOVING:
+            self.interval = max(self.interval / 2, self.MIN_INTERVAL)
+        elif change <= self.STEADY:
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+
+    def stats(self):
+        with self.lock:
+            return {"sensors": len(self.sensors), "rounds": self.rounds,
+                    "bulk": self.bulk, "crc_errors": self.crc_errors,
+                    "failures": self.failures, "interval": self.interval}
 
 
-class Audio(Thread):
-    """docstring for Audio"""
-    def __init__(self):
+class Audio(Source):
+    """PCM mixer volume, followed on the reactor with one mixer handle"""
+    def __init__(self, control="PCM"):
         super(Audio, self).__init__()
+        self.control = control
         self.volume = 0
+        self.mixer = None
 
-    def run(self):
-        self.log.debug("%s thread started" % self.name)
-        polling = select.poll()
-        mix = alsaaudio.Mixer('PCM')
-        with self.lock:
-            self.volume = mix.getvolume()[0]
-        while not self.must_stop.is_set():
-            fd, evmsk = mix.polldescriptors()[0]
-            polling.register(fd, evmsk)
-
-            event = polling.poll()
-            for f, e in event:
-                if e & select.POLLIN:
-                    mix = alsaaudio.Mixer('PCM')
-                    volume = mix.getvolume()[0]
-                    if volume != self.volume:
-                        with self.lock:
-                            self.volume = mix.getvolume()[0]
-                        self.log.debug("volume: %d%%" % volume)
+    def start(self):
+        self.open()
+        self.publish(events.VOLUME, self.volume)
 
-            polling.unregister(fd)
+    def open(self):
+        self.mixer = alsaaudio.Mixer(self.control)
+        with self.lock:
+            self.volume = self.mixer.getvolume()[0]
+        for fd, mask in self.mixer.polldescriptors():
+            self.register(fd, mask, self.on_event)
+
+    def on_event(self, fd, mask):
+        with tracing.span("mixer event", "worker"):
+            if hasattr(self.mixer, "handleevents"):
+                self.mixer.handleevents()
+            else:
+                # pyalsaaudio < 0.8 cannot clear the event nor refresh
+                # the volume: a new handle replaces this one
+                super(Audio, self).stop()
+                self.mixer.close()
+                self.open()
+            volume = self.mixer.getvolume()[0]
+        if volume != self.volume:
+            with self.lock:
+                self.volume = volume
+            self.publish(events.VOLUME, volume)
+            self.log.debug("volume: %d%%" % volume)
 
+    def stop(self):
+        super(Audio, self).stop()
+        if self.mixer is not None:
+            self.mixer.close()
+            self.mixer = None
+
+
+class Input(Source):
+    """Rotary encoder and button
+
+       Both encoder pins are decoded on every edge: a bounce is a back
+       and forth transition and cancels itself out, so no edge is lost
+       to a bouncetime. Detents turned quickly are accelerated in wheel,
+       steps counts them as they are. Both add up until the main loop
+       takes them, once per frame.
+
+       The edges are watched by the reactor through the sysfs GPIO
+       files, or by RPi.GPIO's own thread when there are none."""
+    PIN_A = 17
+    PIN_B = 27
+    PIN_BUTTON = 18
+    SYSFS = "/sys/class/gpio"
+    # clicks closer than this are bounces, seconds
+    BOUNCE = 0.5
+    # transitions per detent
+    DETENT = 4
+    # detents closer than ACCEL_TIME s count for ACCEL_TIME / interval,
+    # ACCEL_MAX at most
+    ACCEL_TIME = 0.1
+    ACCEL_MAX = 5
+    # quarter step of a (previous state << 2 | state) transition,
+    # a state being (A << 1 | B): 11 > 01 > 00 > 10 is clockwise
+    QUADRATURE = (0, -1, 1, 0, 1, 0, 0, -1, -1, 0, 0, 1, 0, 1, -1, 0)
 
-class Input(Thread):
     def __init__(self):
         super(Input, self).__init__()
         self.wheel = 0
+        self.steps = 0
         self.click = False
         self.has_input = threading.Event()
         # Rotary Encoder
-        gpio.setup(17, gpio.IN, gpio.PUD_UP)
-        gpio.setup(27, gpio.IN, gpio.PUD_UP)
+        gpio.setup(self.PIN_A, gpio.IN, gpio.PUD_UP)
+        gpio.setup(self.PIN_B, gpio.IN, gpio.PUD_UP)
         # Button
-        gpio.setup(18, gpio.IN, gpio.PUD_UP)
+        gpio.setup(self.PIN_BUTTON, gpio.IN, gpio.PUD_UP)
         self.log.setLevel(logging.INFO)
-
-    def run(self):
-        self.log.debug("%s thread started" % self.name)
-        gpio.add_event_detect(17, gpio.FALLING,
-                              callback=self.on_low, bouncetime=100)
-        gpio.add_event_detect(18, gpio.FALLING,
-                              callback=self.on_click, bouncetime=500)
-
-    def on_low(self, pin):
-        a = gpio.input(17)
-        b = gpio.input(27)
-        vol = 0
-        if a:
+        self.state = self.read_state()
+        self.last_click = 0
+        self.quarters = 0
+        self.last_detent = 0
+        self.last_step = 0
+        self.edges = 0
+        self.invalid = 0
+        self.detents = 0
+
+    def start(self):
+        for pin in (self.PIN_A, self.PIN_B):
+            self.watch(pin, "both", self.on_edge)
+        self.watch(self.PIN_BUTTON, "falling", self.on_click)
+
+    def watch(self, pin, edge, callback):
+        """Call callback(pin) on the "both" or "falling" edges of pin"""
+        path = "%s/gpio%d" % (self.SYSFS, pin)
+        if backends.BACKEND == "sim" or not os.path.isdir(self.SYSFS):
+            gpio.add_event_detect(
+                pin, gpio.BOTH if edge == "both" else gpio.FALLING,
+                callback=callback)
             return
-        if b:
-            vol = 1
-        else:
-            vol = -1
-        if vol != 0:
-            with self.lock:
-                self.wheel += vol
-            self.has_input.set()
-            self.log.debug("rotate %s %s" % (vol, self.wheel))
-
+        if not os.path.isdir(path):
+            with open(self.SYSFS + "/export", "w") as f:
+                f.write(str(pin))
+        with open(path + "/edge", "w") as f:
+            f.write(edge)
+        fd = os.open(path + "/value", os.O_RDONLY | os.O_NONBLOCK)
+        # an edge is signaled until the value is read again
+        os.read(fd, 8)
+
+        def on_event(fd, mask):
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.read(fd, 8)
+            callback(pin)
+        self.register(fd, select.EPOLLPRI | select.EPOLLERR, on_event,
+                      owned=True)
+
+    def read_state(self):
+        return gpio.input(self.PIN_A) << 1 | gpio.input(self.PIN_B)
+
+    def on_edge(self, pin):
+        now = tools.monotonic()
+        state = self.read_state()
+        with self.lock:
+            self.edges += 1
+            if state == self.state:
+                return
+            quarter = self.QUADRATURE[self.state << 2 | state]
+            self.state = state
+            if quarter == 0:
+                # both pins changed: an edge was missed
+                self.invalid += 1
+                return
+            self.quarters += quarter
+            if abs(self.quarters) < self.DETENT:
+                return
+            step = 1 if self.quarters > 0 else -1
+            self.quarters -= step * self.DETENT
+            self.detents += 1
+            gain = 1
+            interval = now - self.last_detent
+            if step == self.last_step and interval < self.ACCEL_TIME:
+                gain = min(int(self.ACCEL_TIME / interval), self.ACCEL_MAX)
+            self.last_detent = now
+            self.last_step = step
+            self.wheel += step * gain
+            self.steps += step
+        self.log.debug("rotate %s x%d %s" % (step, gain, self.wheel))
+        self.signal(now)
+
+    @tracing.traced
     def on_click(self, pin):
+        now = tools.monotonic()
         with self.lock:
+            if now - self.last_click < self.BOUNCE:
+                return
+            self.last_click = now
             self.click = True
-        self.has_input.set()
         self.log.debug("click!")
+        self.signal(now)
+
+    def signal(self, when):
+        """Wake the main loop, once until it takes the input"""
+        if not self.has_input.is_set():
+            self.has_input.set()
+            self.publish(events.INPUT, when)
+
+    def stats(self):
+        with self.lock:
+            return {"edges": self.edges, "invalid": self.invalid,
+                    "detents": self.detents}
 
 
 if __name__ == '__main__':
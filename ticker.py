@@ -0,0 +1,73 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Scrolling text ticker
+#
+# The text is rasterised once, when it changes, into an off-screen strip
+# with a blank screen width on both sides. Every frame crops a screen
+# wide window out of it, at a position driven by the elapsed time
+# (CLOCK_MONOTONIC, so setting the clock does not move the text): the
+# speed is in pixels per second whatever the frame rate, and fractional
+# positions are drawn by blending the two nearest pixel positions.
+# ----------------------------------------------------------------------
+
+from PIL import Image, ImageDraw
+
+import tools
+
+
+class Ticker(object):
+    """Text scrolling from right to left over `width` pixels"""
+
+    def __init__(self, width, font, speed):
+        self.width = width
+        self.font = font
+        self.speed = speed
+        self.text = None
+        self.strip = None
+        self.period = width
+        self.start = 0
+        self.renders = 0
+
+    def set_text(self, text, now=None):
+        """Render `text` into the strip, and restart scrolling,
+           if it changed"""
+        if text == self.text:
+            return
+        self.text = text
+        w, h = self.font.getsize(text)
+        # one pixel more for the blending of the last position
+        self.strip = Image.new("L", (self.width + w + self.width + 1, h))
+        ImageDraw.Draw(self.strip).text((self.width, 0), text,
+                                        font=self.font, fill=255)
+        self.period = self.width + w
+        self.start = tools.monotonic() if now is None else now
+        self.renders += 1
+
+    def reset(self):
+        """Forget the text, the next one starts from the right edge"""
+        self.text = None
+        self.strip = None
+
+    def position(self, now=None):
+        """Scroll offset at tools.monotonic() time `now`, in pixels"""
+        if now is None:
+            now = tools.monotonic()
+        return ((now - self.start) * self.speed) % self.period
+
+    def window(self, offset):
+        """Coverage mask of the visible part of the text at `offset`"""
+        x = int(offset)
+        frac = offset - x
+        h = self.strip.size[1]
+        mask = self.strip.crop((x, 0, x + self.width, h))
+        if frac:
+            after = self.strip.crop((x + 1, 0, x + 1 + self.width, h))
+            mask = Image.blend(mask, after, frac)
+        return mask
+
+    def draw(self, im, xy, color, offset):
+        """Paste the text at `offset` on `im`, at `xy`"""
+        if self.strip is None:
+            return
+        im.paste(color, xy, self.window(offset))
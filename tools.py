@@ -1,21 +1,42 @@
 #!/bin/env python
 # -*- coding: UTF-8 -*-
 
+import ctypes
+import ctypes.util
+import os
 import time
-from functools import wraps
-import logging
-
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-
-
-def timed(f):
-    @wraps(f)
-    def wrapper(*args, **kwds):
-        start = time.time()
-        result = f(*args, **kwds)
-        elapsed = time.time() - start
-        log.debug("%s took %dms to finish" % (f.__name__, elapsed*1000))
-        #print "%s took %dms to finish" % (f.__name__, elapsed*1000)
-        return result
-    return wrapper
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime():
+    """clock_gettime() from the C library, None if not found"""
+    for name in ("rt", "c"):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            f = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        f.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        return f
+    return None
+
+_gettime = _clock_gettime()
+
+
+def monotonic():
+    """Seconds from CLOCK_MONOTONIC: unlike time.time(), it never jumps
+       when the clock is set (python 2 has no time.monotonic)"""
+    if _gettime is None:
+        return time.time()
+    ts = timespec()
+    if _gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
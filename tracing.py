@@ -0,0 +1,131 @@
+#!/bin/env python
+# -*- coding: UTF-8 -*-
+# ----------------------------------------------------------------------
+# Always-on tracer
+#
+# Spans (name, start, duration, thread) from the main loop, the worker
+# threads, the MPD commands and the SPI writes are recorded in a fixed
+# size ring buffer, so the last few seconds before a stall can be looked
+# at. The buffer is dumped as Chrome trace JSON (chrome://tracing,
+# ui.perfetto.dev) on SIGUSR1, or by the main loop when a frame overruns.
+#
+# Recording a span is a couple of clock reads and a list store, cheap
+# enough to stay enabled.
+# ----------------------------------------------------------------------
+
+import os
+import json
+import signal
+import thread
+import threading
+import itertools
+import logging
+import time
+from functools import wraps
+
+import tools
+
+# dump file, a %s in it is replaced by the dump time
+PATH = os.environ.get("PIOCLOCK_TRACE", "/tmp/pioclock-trace-%s.json")
+
+log = logging.getLogger(__name__)
+
+
+class Span(object):
+    __slots__ = ("tracer", "name", "cat", "start")
+
+    def __init__(self, tracer, name, cat):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = tools.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.cat, self.start,
+                           tools.monotonic() - self.start)
+
+
+class Tracer(object):
+    """Ring buffer of the last `size` spans"""
+
+    def __init__(self, size=16384):
+        self.size = size
+        self.spans = [None] * size
+        # next() on a count is atomic under the GIL, no lock needed
+        self.counter = itertools.count()
+        self.names = {}
+        self.last_dump = None
+
+    def span(self, name, cat="main"):
+        """Context manager recording its block as a span"""
+        return Span(self, name, cat)
+
+    def record(self, name, cat, start, duration):
+        tid = thread.get_ident()
+        if tid not in self.names:
+            self.names[tid] = threading.current_thread().name
+        self.spans[next(self.counter) % self.size] = \
+            (name, cat, start, duration, tid)
+
+    def snapshot(self):
+        """Recorded spans, oldest first"""
+        spans = [s for s in list(self.spans) if s is not None]
+        spans.sort(key=lambda s: s[2])
+        return spans
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                   "args": {"name": name}}
+                  for tid, name in self.names.items()]
+        for name, cat, start, duration, tid in self.snapshot():
+            events.append({"name": name, "cat": cat, "ph": "X",
+                           "ts": int(start * 1e6), "dur": int(duration * 1e6),
+                           "pid": pid, "tid": tid})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path=None, reason=""):
+        """Write the buffer to `path` (PATH by default), return the path"""
+        if path is None:
+            path = PATH.replace("%s", time.strftime("%Y%m%d-%H%M%S"))
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        self.last_dump = tools.monotonic()
+        log.warning("trace dumped to %s %s" % (path, reason))
+        return path
+
+    def dump_overrun(self, duration, every=60):
+        """Dump after a frame overrun, at most once every `every` s"""
+        if self.last_dump is not None and \
+           tools.monotonic() - self.last_dump < every:
+            return None
+        return self.dump(reason="(frame took %.3fs)" % duration)
+
+    def install(self, signum=signal.SIGUSR1):
+        """Dump the buffer on `signum` (main thread only)"""
+        def handler(signum, frame):
+            # never let a failed dump kill the interrupted main loop
+            try:
+                self.dump(reason="(signal %d)" % signum)
+            except Exception, e:
+                log.error("cannot dump trace: %s" % e)
+        signal.signal(signum, handler)
+
+
+tracer = Tracer()
+
+
+def span(name, cat="main"):
+    return tracer.span(name, cat)
+
+
+def traced(f):
+    """Record every call of f as a span"""
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        with tracer.span(f.__name__, "call"):
+            return f(*args, **kwds)
+    return wrapper